@@ -1,571 +1,3356 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Tue Sep 29 10:10:08 2015
-CEPAC Cluster tool library
-
-STD list:
-* objectify things
-* GUI
-* make zipped download work
-* fix jobname and folder name thing
-* kill jobs
-
-@author: Taige Hou (thou1@partners.org)
-@author: Kai Hoeffner (khoeffner@mgh.harvard.edu)
-"""
-from __future__ import print_function
-import os
-import sys
-import glob
-import paramiko
-import md5
-import re
-import zipfile
-import threading
-import time
-from stat import S_ISDIR
-import getpass
-
-#A list of clusters
-CLUSTER_NAMES = ("MGH", "Orchestra", "Custom")
-#Maximum number of concurrent connections
-MAX_CONNECTIONS = 8
-
-#Mapping of cluster names to hostname, runfolder path and model folder path
-#For run_folder use only relative path from home directory (this is required as lsf and cepac are picky about paths)
-#For model_folder can use either absolute path or relative path from home directory
-#do not use ~ in path to represent home directory as the ftp client cannot find the directory
-CLUSTER_INFO = {"MGH":{'host':'erisone.partners.org',
-                       'run_folder':'runs',
-                       'model_folder':'/data/cepac/modelVersions',
-                       'default_queues':("medium", "long", "vlong", "big")},
-                "Orchestra":{'host':'orchestra.med.harvard.edu',
-                       'run_folder':'runs',
-                       'model_folder':'/groups/freedberg/modelVersions',
-                       'default_queues':("freedberg_2h", "freedberg_12h", "freedberg_1d", "freedberg_7d", "freedberg_unlim",
-                                         "short", "long")},
-                "Custom":{'host':'',
-                       'run_folder':'runs',
-                       'model_folder':'',
-                       'default_queues':()},
-                }
-#---------------------------------------------
-class UploadThread(threading.Thread):
-    """Thread used to upload runs and submit jobs"""
-    def __init__(self, cluster, dir_local, dir_remote, lsfinfo, update_func, glob_pattern="*.in" ):
-        threading.Thread.__init__(self)
-        self.cluster = cluster
-        self.args = [self, dir_local, dir_remote, lsfinfo, update_func, glob_pattern]
-        self.abort = False
-    def stop(self):
-        self.abort = True
-    def run(self):
-        while self.cluster.num_connections >= MAX_CONNECTIONS:
-            time.sleep(.2)
-        self.cluster.num_connections+=1
-        jobfiles = self.cluster.sftp_upload(*self.args)
-        if not self.abort:
-            self.cluster.pybsub(jobfiles)
-        self.cluster.num_connections-=1
-
-#---------------------------------------------
-class DownloadThread(threading.Thread):
-    """Thread used to download runs"""
-    def __init__(self, cluster, run_folder,  dir_remote, dir_local, update_func):
-        threading.Thread.__init__(self)
-        self.cluster = cluster
-        self.args = [self, dir_remote, dir_local, update_func]
-        self.abort = False
-        self.run_folder = run_folder
-        #Total number of files to download
-        self.total_files = 0
-        #current progress of download
-        self.curr_files = 0
-    def stop(self):
-        self.abort = True
-    def run(self):
-        while self.cluster.num_connections >= MAX_CONNECTIONS:
-            time.sleep(.2)
-            
-        #counts total number of files in folder recursively
-        stdin, stdout, stderr =  self.cluster.ssh.exec_command("find {} -type f | wc -l"
-                                                       .format(clean_path(self.cluster.run_path+"/"+self.run_folder)))
-        #wait for command to finish
-        stdout.channel.recv_exit_status()
-        self.total_files = int(stdout.read().strip())
-        if self.total_files == 0:
-            self.total_files = 1
-        self.cluster.num_connections+=1
-        #self.cluster.sftp_get_compressed(*self.args)
-        self.cluster.sftp_get_recursive(*self.args)
-        self.cluster.num_connections-=1
-        
-#---------------------------------------------
-class JobInfoThread(threading.Thread):
-    """Thread used to get detailed job info"""
-    def __init__(self, cluster, jobid, post_func):
-        threading.Thread.__init__(self)
-        self.cluster = cluster
-        self.jobid = jobid
-        #function which tells thread how to post results
-        self.post_func = post_func
-    def run(self):
-        while self.cluster.num_connections >= MAX_CONNECTIONS:
-            time.sleep(.2)
-        self.cluster.num_connections+=1
-        job_info = self.cluster.get_job_info(self.jobid)
-        self.post_func(jobid = self.jobid, data = job_info)
-        self.cluster.num_connections-=1
-        
-#---------------------------------------------
-class CEPACClusterApp:
-    """Basic class for the desktop interface with the CEPAC cluster"""
-    def __init__(self,):
-        self.port = 22
-
-        #SSH Client
-        self.ssh = paramiko.SSHClient()
-
-        #Dictionary of available model versions with model type as keys
-        self.model_versions = None
-        #List of available run queues
-        self.queues = None
-        #number of currently open connections
-        self.num_connections = 0
-        #thread for uploading
-        self.upload_thread = None
-        #threads for downloads
-        self.download_threads = []
-    def bind_output(self, output=print):
-        """
-        output is a function used to write messages from the app.
-        Defaults to the print function for the console version.
-        Any calls to print should use the self.output function instead
-        """
-        self.output = output
-        
-        #print initiation message
-        self.output("="*40, False)
-        self.output("Initiating Cepac Cluster App", False)
-    def connect(self, hostname='erisone.partners.org',
-                username=None, password=None,
-                run_path=None, model_path=None, clustername=None):
-        """
-        Starts connection to host.
-        Should be called once per client.
-        """
-        #Close any previous connections
-        self.close_connection()
-        
-        #Need to convert to string for paramiko because input could be unicode
-        self.hostname = str(hostname)
-        self.username = str(username)
-        self.password = str(password)
-        self.run_path = str(run_path)
-        self.model_path = str(model_path)
-        self.clustername = str(clustername)
-
-        self.output("\nConnecting to {} as user: {}...".format(self.hostname, self.username), False)
-
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            self.ssh.connect(self.hostname,port=22,username=self.username,password=self.password)
-        except paramiko.AuthenticationException:
-            #Login failed
-            self.output("\tLogin Failed", False)
-        else:
-            #Get model and queue information
-            self.output("\tLogin Succesful", False)
-            self.update_cluster_information()
-    def create_upload_thread(self, *args, **kwargs):
-        self.upload_thread = UploadThread(self, *args, **kwargs)
-        self.upload_thread.start()
-    def create_download_thread(self, *args, **kwargs):
-        thread = DownloadThread(self, *args, **kwargs)
-        thread.start()
-    def sftp_get_recursive(self, thread, dir_remote, dir_local, progress_func, sftp = None):
-        """Recursively Downloads folder including subfolders"""
-        if not sftp:
-            #Create sftp object. Should only do this once per download.
-            with paramiko.Transport((self.hostname, self.port)) as t:
-                t.connect(username=self.username, password=self.password)
-                t.use_compression()
-                #recomended window size from https://github.com/paramiko/paramiko/issues/175
-                t.window_size = 134217727
-                
-                sftp = t.open_session()
-                sftp = paramiko.SFTPClient.from_transport(t)
-                progress_func(0, thread.run_folder)
-                self.output("\nDownloading from folder {} to folder {}...".format(dir_remote, dir_local))
-                self.sftp_get_recursive(thread, dir_remote, dir_local, progress_func, sftp)
-                self.output("\tDownload Complete")
-        else:
-            item_list = sftp.listdir(dir_remote)
-            dir_local = str(dir_local)
-            dir_local = os.path.join(dir_local, os.path.basename(dir_remote))
-
-            if not os.path.isdir(dir_local):
-                os.makedirs(dir_local)
-
-            for item in item_list:
-                item = str(item)
-
-                if isdir(dir_remote + "/" + item, sftp):
-                    self.sftp_get_recursive(thread, dir_remote + "/" + item, dir_local, progress_func, sftp)
-                else:
-                    sftp.get(dir_remote + "/" + item, os.path.join(dir_local,item))
-                    thread.curr_files+=1
-                    progress_func(thread.curr_files/float(thread.total_files)*100, thread.run_folder)
-#    def sftp_get_compressed(self, dir_remote, dir_local, sftp = None):                    
-#        """Download everything as one file"""
-#        compfile = "compfile.tar.gz"
-#        self.output("\nCompressing {}".format(dir_remote))
-#        stdin, stdout, stderr = self.ssh.exec_command("tar -zcf ~/{} ~/{} ".format(compfile, dir_remote))
-#        
-#        
-#        if not stdout.readlines():
-#            #Create sftp object
-#            with paramiko.Transport((self.hostname, self.port)) as t:
-#                t.connect(username=self.username, password=self.password)
-#                t.use_compression()
-#                #recomended window size from https://github.com/paramiko/paramiko/issues/175
-#                t.window_size = 134217727
-#                sftp = t.open_session()
-#                sftp = paramiko.SFTPClient.from_transport(t)
-#                # This should be stored somewhere locally for faster access!
-#                dir_temp_local='C:\Temp'
-#                
-#                sftp.get("~/{}".format(compfile), dir_temp_local+"\CEPACclusterdownload.zip")
-#                self.output("\nDownload complete!")
-#    
-#            stdin, stdout, stderr = ssh.exec_command("rm {}".format(compfile))
-#            self.output("\nExtracting files")
-#            with zipfile.ZipFile(dir_temp_local+"CEPACclusterdownload.zip", "r") as z:
-#                z.extractall(dir_local)
-#        else:
-#            self.output(stdout.readlines())
-            
-            
-
-
-    def sftp_upload(self, thread, dir_local, dir_remote, lsfinfo, progress_func, glob_pattern = "*.in"):
-        """Uploads local directory to remote server and generates a job file per subfolder and returns the list of job files."""
-        files_copied = 0
-        jobfiles = []
-
-        #Create sftp object
-        with paramiko.Transport((self.hostname, self.port)) as t:
-            t.connect(username=self.username, password=self.password)
-            t.use_compression()
-            #recomended window size from https://github.com/paramiko/paramiko/issues/175
-            t.window_size = 134217727
-            sftp = t.open_session()
-            sftp = paramiko.SFTPClient.from_transport(t)
-            self.output("\nSubmitting runs from folder {} ...".format(dir_local))
-            #list of tuples (local_file, remote file) that will be uploaded
-            files_to_upload = []
-            for dirpath, dirnames, filenames in os.walk(dir_local):
-                matching_files = [f for f in glob.glob(dirpath + os.sep + glob_pattern) if not os.path.isdir(f)]
-
-                if not matching_files:
-                    continue
-                
-                # Fix foldername
-                remote_base = dir_remote + '/' + os.path.basename(dir_local)
-                if not os.path.relpath(dirpath, dir_local)=='.':
-                    curr_dir_remote = remote_base + '/' + os.path.relpath(dirpath,dir_local).replace("\\","/")
-                else:
-                    curr_dir_remote = remote_base
-                
-                # Create folder and subfolders
-                stdin, stdout, stderr = self.ssh.exec_command("mkdir -p '{}'".format(curr_dir_remote))
-                #wait for command to finish
-                stdout.channel.recv_exit_status()
-                self.output("\tCreating {}".format(curr_dir_remote))
-                
-                # Write and collect job files
-                if thread.abort:
-                    return None
-                self.write_jobfile(curr_dir_remote, lsfinfo, sftp)
-                jobfiles.append(curr_dir_remote + '/job.info')                
-                
-                # Upload files
-                for fpath in matching_files:
-                    is_up_to_date = False
-                    fname = os.path.basename(fpath)
-
-                    local_file = fpath
-                    remote_file = curr_dir_remote + '/' + fname
-                    # if remote file exists
-                    try:
-                        sftp.stat(remote_file)
-                    except IOError:
-                        pass
-                    else:
-                        local_file_data = open(local_file, "rb").read()
-                        remote_file_data = sftp.open(remote_file).read()
-                        md1 = md5.new(local_file_data).digest()
-                        md2 = md5.new(remote_file_data).digest()
-                        if md1 == md2:
-                            is_up_to_date = True
-
-                    if not is_up_to_date:
-                        files_to_upload.append((local_file, remote_file))
-
-            progress_func(0)
-            #upload files
-            for local_file, remote_file in files_to_upload:
-                if thread.abort:
-                    return None
-                self.output('\tCopying {} to {}'.format(local_file, remote_file))                     
-                sftp.put(local_file, remote_file)
-                files_copied += 1
-                #update progress bar
-                progress_func(files_copied/float(len(files_to_upload))*100)
-            self.output('\tFinished Upload')
-
-        return jobfiles
-    def write_jobfile(self, curr_dir_remote, lsfinfo, sftp):
-        """
-        Write job files for the current folder.
-        lsfinfo is a dictionary which contains
-            queue - the queue to submit to
-            email - email address to send upon job completion (optional)
-            modeltype - should be either treatm, debug, or transm
-            modelversion - name of the model version to run
-        """
-        self.output('\tWriting Job file: {}'.format(curr_dir_remote + '/job.info'))
-        with sftp.open(curr_dir_remote + '/job.info', 'wb') as f:
-            jobcommand = "#!/bin/bash\n" +\
-                         "#BSUB -J \"" + lsfinfo['jobname'] + "\"\n" +\
-            "#BSUB -q " + lsfinfo['queue']   + "\n"
-            if 'email' in lsfinfo:
-                jobcommand += "#BSUB -u " + lsfinfo['email']   + "\n" + \
-                "#BSUB -N\n"
-            if lsfinfo['modeltype'] != "smoking":
-                jobcommand += self.model_path + "/" + lsfinfo['modeltype'] + "/" + lsfinfo['modelversion'] + " ~/" + clean_path(curr_dir_remote)
-            else:
-                jobcommand += "/data/cepac/python/bin/python3.6 " + self.model_path + "/" + lsfinfo['modeltype'] + "/"+ \
-                                lsfinfo['modelversion'] + "/sim.py" + " ~/" + clean_path(curr_dir_remote) 
-            
-            
-            f.write(jobcommand)
-    def pybsub(self, jobfiles):
-        """Submit jobs for job list to LSF"""
-        for job in jobfiles:      
-            stdin, stdout, stderr =  self.ssh.exec_command("bash -lc bsub < '{}'".format(job))
-            stdout.read()
-            err = stderr.read()
-            if err.strip():
-                self.output('Error: {}'.format(err))
-            self.output('\tSubmitted :{}'.format(job))
-    def get_run_folders(self):
-        """
-        Gets the names of all the folders in the run_folder on the cluster
-        and returs as a list
-        """
-        self.output("\nRetrieving run folders ...", False)
-        #use ls -1 {}| awk  '{$1=$2=""; print 0}' to get long form data but not very useful
-        stdin, stdout, stderr = self.ssh.exec_command("ls -1 {}".format(self.run_path))
-        run_folders = stdout.readlines()
-
-        self.output("\tFound {} run folders".format(len(run_folders)), False)
-        return run_folders
-    def delete_run_folders(self, folderlist):
-        """Deletes the list of folders from the cluster"""
-        self.output("\nDeleting Run Folders ...", False)
-        for folder in folderlist:
-            self.output("\tDeleting {}".format(folder), False)
-            stdin, stdout, stderr = self.ssh.exec_command("rm -rf {}".format(self.run_path+"/"+clean_path(folder)))
-        self.output("\tFinished Deleting", False)
-    def get_job_list(self):
-        """
-        Gets some basic information about currently running jobs
-        Returns jobid, status and queue
-        For detailed job info use get_job_info
-        """
-        self.output("\nGetting job listing ...", False)
-        #Get job listing and format the result
-        stdin, stdout, stderr = self.ssh.exec_command("bash -lc bjobs | awk '{if (NR!=1) print $1,$3,$4}'")
-        #Each entry in Job data will be a list [jobid, status, queue]
-        job_data = [line.split() for line in stdout.readlines()]
-
-        return job_data
-    def get_job_info(self, jobid):
-        """
-        Returns detailed job information by running bjobs -l
-        Returns a tuple of (jobname, modelname, runfolder)
-        """
-        stdin, stdout, stderr = self.ssh.exec_command("bash -lc 'bjobs -l {}'".format(jobid))
-        #read here to add delay and avoid being blocked by server
-        #wait for command to finish
-        stdout.channel.recv_exit_status()
-
-        #read job info and get rid of extra spaces
-        job_data = re.sub("\n\s*","",stdout.read())
-        #get jobname, modelname, runfolder from job info
-        re_pattern ="Job Name <(.*?)>.*" +\
-                    "Command <.*?{}/.*?/(.*?)".format(self.model_path) +\
-                    "~/{}/(.*?)>".format(self.run_path)
-
-        match = re.search(re_pattern, job_data)
-        if match:
-            job_name, model_version, run_folder = match.groups()
-            run_folder = reverse_clean_path(run_folder)
-            model_version = model_version.strip()
-            return (job_name, model_version, run_folder)
-        else:
-            return None
-    def kill_jobs(self, joblist):
-        """Kills jobs with jobids given in joblist"""
-        self.output("\nKilling Jobs...", False)
-        for jobid in joblist:
-            stdin, stdout, stderr = self.ssh.exec_command("bash -lc 'bkill {}'".format(jobid))
-            stdout.channel.recv_exit_status()
-        self.output("\t {} jobs killed".format(len(joblist)), False)
-    def update_cluster_information(self):
-        """
-        Updates the names of all model versions along with model type(debug, treatm, transm)
-        Updates the lists of available queues
-        Should be called when logging in
-        """
-
-        self.output("\tRetrieving model and queue information...", False)
-        stdin, stdout, stderr = self.ssh.exec_command("ls -1 {}".format(self.model_path))
-        model_types = [m_type.strip() for m_type in stdout.readlines()]
-        model_versions = {}
-        for m_type in model_types:
-            #For each model type get the associated model versions
-            stdin, stdout, stderr = self.ssh.exec_command("ls -1 {}".format(self.model_path+"/"+m_type))
-            model_versions[m_type] = [m_version.strip() for m_version in stdout.readlines()]
-
-        self.model_versions = model_versions
-
-        stdin, stdout, stderr = self.ssh.exec_command("ls -1 {}".format(self.model_path))
-        model_types = [m_type.strip() for m_type in stdout.readlines()]
-        model_versions = {}
-
-        #Gets a list of queues by calling bqueues and filtering the output
-        if CLUSTER_INFO[self.clustername]['default_queues']:
-            self.queues = CLUSTER_INFO[self.clustername]['default_queues']
-        else:
-            stdin, stdout, stderr = self.ssh.exec_command("bash -lc bqueues -w | awk '{if (NR!=1) print $1}'")
-            self.queues = [q.strip() for q in stdout.readlines()]
-        self.output("\tDone", False)
-
-    def close_connection(self):
-        self.ssh.close()
-    def __del__(self):
-        #closes SSH connection upon exit
-        self.close_connection()
-     
-#---------------------------------------------
-# Helper function
-def isdir(path, sftp):
-  try:
-    return S_ISDIR(sftp.stat(path).st_mode)
-  except IOError:
-    #Path does not exist, so by definition not a directory
-    return False
-
-#---------------------------------------------
-# Helper function
-def clean_path(path):
-    """Cleans a filepath for use on cluster by adding escape characters"""
-    esc_chars = ['&',';','(',')','$','`','\'',' ']
-    for c in esc_chars:
-        path = path.replace(c, "\\"+c)
-    return path
-
-#---------------------------------------------
-# Helper function
-def reverse_clean_path(path):
-    """Removes escape characters from path"""
-    return path.replace("\\","")
-
-
-        
-#---------------------------------------------
-
-        
-#---------------------------------------------
-
-    
-#----------------------------------------------------------------------
-if __name__ == "__main__":
-    hostname = 'erisone.partners.org'
-    username = 'kh398'
-    password = getpass.getpass("Password: ")
-    port = 22
-    glob_pattern='*.*' # can be used to only copy a specific type of file, e.g. '.in'
-
-    lsfinfo = {
-    'email'        : "khoeffner@mgh.harvard.edu",
-    'modelversion' : "cepac45c",
-    'jobname'      : "R6",
-    'queue'        : "medium"    
-    }
-
-    dir_local = 'Z:\CEPAC - International\Projects\Hoeffner\Ongoing Projects\DTG-1stART-RLS\Analysis\DEV0\Run1_3\R6'
-    dir_remote = "runs/" + lsfinfo['jobname']
-
-    if sys.argv[1].lower() == 'upload':
-        with paramiko.Transport((hostname, port)) as t:
-            t.connect(username=username, password=password)
-            sftp = t.open_session()
-            sftp = paramiko.SFTPClient.from_transport(t)
-            jobfiles = sftp_upload(dir_local, dir_remote, glob_pattern, lsfinfo, sftp)
-
-        if len(sys.argv) > 2 and sys.argv[2].lower() == 'submit':        
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname, username=username, password=password)
-                pybsub(jobfiles, ssh)
-                
-    
-    if sys.argv[1].lower() == 'status':
-        # Get job status
-        with paramiko.SSHClient() as ssh:
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(hostname, username=username, password=password)
-            stdin, stdout, stderr = ssh.exec_command("bjobs")
-            if stdout.readlines():
-                for line in stdout.readlines():
-                    print(line.split())
-            else:
-                print(stderr.readlines())  
-            
-    if sys.argv[1].lower() == 'download':            
-    # Download everything - Use this after the runs are done
-        with paramiko.Transport((hostname, port)) as t:
-            t.connect(username=username, password=password)
-            t.use_compression() 
-            sftp = t.open_session()
-            sftp = paramiko.SFTPClient.from_transport(t)
-            sftp_get_recursive(dir_remote, dir_local, sftp)
-            print("Download complete!")
-
-    
-# Download everything in a zip file - Still needs to be fixed because the path is wrong
-#    with paramiko.SSHClient() as ssh:
-#        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-#        ssh.connect(hostname, username=username, password=password)
-#        stdin, stdout, stderr = ssh.exec_command("zip -9 -y -r -q ~/runs/R500.zip "+dir_remote)
-#    
-#        if not stdout.readlines():
-#            with paramiko.Transport((hostname, port)) as t:
-#                t.connect(username=username, password=password)
-#                t.use_compression() 
-#                sftp = t.open_session()
-#                sftp = paramiko.SFTPClient.from_transport(t)
-#                # This should be stored somewhere locally for faster access!
-#                dir_local='C:\MyTemp'
-#                sftp.get("runs/R500.zip", dir_local+"\R500.zip")
-#                print("Download complete!")
-#    
-#            stdin, stdout, stderr = ssh.exec_command("rm runs/R500.zip")
-#    
-#    print("Extracting files")
-#    with zipfile.ZipFile(dir_local+"\R500.zip", "r") as z:
-#        z.extractall(dir_local)    
-    
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Sep 29 10:10:08 2015
+CEPAC Cluster tool library
+
+STD list:
+* objectify things
+* GUI
+* make zipped download work
+* fix jobname and folder name thing
+* kill jobs
+
+@author: Taige Hou (thou1@partners.org)
+@author: Kai Hoeffner (khoeffner@mgh.harvard.edu)
+"""
+from __future__ import print_function
+import os
+import sys
+import fnmatch
+import paramiko
+import hashlib
+import json
+import csv
+import re
+import tarfile
+import io
+import posixpath
+import threading
+import time
+import socket
+import itertools
+import random
+import base64
+import collections
+from contextlib import contextmanager
+from stat import S_ISDIR, S_ISLNK
+import getpass
+import tempfile
+import shutil
+import logging
+import logging.handlers
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    from os import scandir
+except ImportError:
+    #python 2 without the scandir backport walks with os.walk
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+#A list of clusters
+CLUSTER_NAMES = ("MGH", "Orchestra", "Custom")
+#Number of scheduler workers running uploads, downloads and queries at the same time,
+#each using sftp clients and exec channels of the pooled transports
+MAX_CONNECTIONS = 8
+#Number of long lived transports kept open by the connection pool
+POOL_TRANSPORTS = 2
+#Maximum number of idle sftp clients kept around for reuse
+POOL_IDLE_SFTP = MAX_CONNECTIONS
+#Most sessions (sftp clients, idle or not, and exec channels) open on one transport.
+#OpenSSH refuses more than 10 per connection by default (MaxSessions)
+MAX_SESSIONS = 10
+#Seconds between keepalive packets on pooled transports
+KEEPALIVE_INTERVAL = 30
+#Sustained rate of remote commands in commands per second and the burst allowed above it
+COMMAND_RATE = 5.0
+COMMAND_BURST = 10
+#Lowest rate the executor slows down to when the server refuses channels
+COMMAND_MIN_RATE = 0.5
+#Maximum number of remote commands running at the same time
+MAX_COMMANDS = 6
+#Maximum number of long running streams (tar transfers, listings) open at the same time.
+#They are capped separately so they never hold the slots of short commands
+MAX_STREAMS = MAX_CONNECTIONS
+#Number of retries and first delay in seconds when a command channel cannot be opened
+COMMAND_RETRIES = 5
+COMMAND_BACKOFF = 0.5
+#Seconds to wait for the remote helper to answer when it is started
+AGENT_START_TIMEOUT = 20
+#LSF commands the remote helper is allowed to run
+AGENT_LSF_COMMANDS = ("bjobs", "bkill", "bsub", "bqueues")
+#Priority classes for scheduled tasks. Lower values are started first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_TRANSFER = 10
+PRIORITY_SHUTDOWN = 100
+#Workers of the scheduler kept for interactive tasks so they never wait for a transfer to finish
+INTERACTIVE_WORKERS = 1
+#Block size used when reading local files for hashing
+HASH_BLOCK_SIZE = 1024*1024
+#Number of bytes read at a time when streaming remote listings
+SCAN_CHUNK_SIZE = 32768
+#Number of bytes copied at a time when downloading files
+TRANSFER_BLOCK_SIZE = 32768
+#Number of files of a folder transferred at the same time over separate sftp channels
+TRANSFER_CONCURRENCY = 4
+#Files larger than this are split into ranges of this size which are transferred in parallel
+RANGE_SPLIT_SIZE = 32*1024*1024
+#Number of files buffered between the stages of the upload pipeline
+PIPELINE_QUEUE_SIZE = 256
+#Number of threads hashing local files during an upload
+HASH_WORKERS = 2
+#Suffix of partially downloaded files
+PARTIAL_SUFFIX = ".part"
+#Suffix of files downloaded as ranges in parallel. They are never continued
+RANGES_SUFFIX = ".ranges" + PARTIAL_SUFFIX
+#Archive of a run folder's files written by its job when lsfinfo['compress_results'] is set,
+#and the list of the files in it as lines of "size name"
+RESULT_ARCHIVE = "cepac_results.tar.gz"
+RESULT_MANIFEST = "cepac_results.manifest"
+#Input files that make a folder a run folder. A result archive also holds the files in subfolders
+#of its run folder, up to nested run folders which have their own archive
+RUN_INPUT = "*.in"
+#Files whose mtimes differ by less than this many seconds are considered unchanged
+MTIME_TOLERANCE = 1
+#Folder used for the tool's local caches
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cepac_cluster_tool")
+#Held while a json file in the caches is read or replaced so threads never see a half replaced file
+JSON_LOCK = threading.RLock()
+#Seconds cached cluster information is used before it is refreshed in the background
+MODEL_VERSION_CACHE_TTL = 24*3600
+QUEUE_CACHE_TTL = 24*3600
+RUN_FOLDER_CACHE_TTL = 120
+#Largest job array submitted at once. LSF rejects arrays above MAX_JOB_ARRAY_SIZE (default 1000)
+MAX_ARRAY_SIZE = 1000
+#Estimated work of a single input file in bytes of input when packing folders into jobs
+PACK_FILE_WORK = 65536
+#Seconds between job status polls
+STATUS_POLL_INTERVAL = 30
+#Seconds between reads of the files of a followed job
+FOLLOW_POLL_INTERVAL = 5
+#Bytes shown from the end of each file that already exists when following starts
+FOLLOW_TAIL_BYTES = 2048
+#Most bytes read of one file per poll. Anything appended before that is skipped
+FOLLOW_MAX_BYTES = 65536
+#Files of a run folder that are not followed
+FOLLOW_EXCLUDE = ("*.in", "*.info", "*.map", RESULT_ARCHIVE, RESULT_MANIFEST, "*" + PARTIAL_SUFFIX)
+#Seconds between progress reports of a transfer
+PROGRESS_INTERVAL = 0.25
+#Weight of the newest sample in the moving average transfer rate
+PROGRESS_SMOOTHING = 0.3
+#Number of output lines held for the GUI before the oldest are dropped
+LOG_BUFFER_LINES = 5000
+#Size in bytes and number of old files kept by the rotating output log
+LOG_SPILL_BYTES = 1024*1024
+LOG_SPILL_BACKUPS = 3
+#Fields requested from bjobs for the job listing. Widths stop lsf from truncating long values
+#command has to be last because it can contain the delimiter
+BJOBS_FIELDS = "jobid jobindex stat queue job_name:512 command:4096"
+BJOBS_DELIMITER = "^"
+
+#Mapping of cluster names to hostname, runfolder path and model folder path
+#For run_folder use only relative path from home directory (this is required as lsf and cepac are picky about paths)
+#For model_folder can use either absolute path or relative path from home directory
+#do not use ~ in path to represent home directory as the ftp client cannot find the directory
+CLUSTER_INFO = {"MGH":{'host':'erisone.partners.org',
+                       'run_folder':'runs',
+                       'model_folder':'/data/cepac/modelVersions',
+                       'default_queues':("medium", "long", "vlong", "big")},
+                "Orchestra":{'host':'orchestra.med.harvard.edu',
+                       'run_folder':'runs',
+                       'model_folder':'/groups/freedberg/modelVersions',
+                       'default_queues':("freedberg_2h", "freedberg_12h", "freedberg_1d", "freedberg_7d", "freedberg_unlim",
+                                         "short", "long")},
+                "Custom":{'host':'',
+                       'run_folder':'runs',
+                       'model_folder':'',
+                       'default_queues':()},
+                }
+#Item of a remote folder listing. path is relative to the listed folder,
+#type is f for files, d for directories and l for links, mtime is in seconds since the epoch
+RemoteEntry = collections.namedtuple("RemoteEntry", ["path", "type", "size", "mtime"])
+#Selects the files of a remote listing. include and exclude are lists of glob patterns matched
+#against file names, files must match one include pattern (if any) and no exclude pattern.
+#max_size is the largest file in bytes or None. Folders are always listed
+FileFilter = collections.namedtuple("FileFilter", ["include", "exclude", "max_size"])
+#Output of a remote command run by the RemoteExecutor
+CommandResult = collections.namedtuple("CommandResult", ["exit_status", "stdout", "stderr"])
+#Progress of a transfer or of all transfers as reported by the ProgressTracker.
+#Rates are in bytes per second, throughput over the last report interval and rate as a moving average.
+#eta is in seconds and None if unknown
+ProgressInfo = collections.namedtuple("ProgressInfo", ["name", "done_bytes", "total_bytes", "percent",
+                                                       "throughput", "rate", "eta"])
+#Information about a job on the cluster as returned by get_job_list
+JobRecord = collections.namedtuple("JobRecord", ["jobid", "status", "queue", "job_name",
+                                                 "command", "model_version", "run_folder"])
+#Source of the helper started on the cluster by RemoteAgent. Runs under python 2.6+ or 3.
+#Reads one json request per line from stdin and writes one json response per line
+AGENT_SOURCE = r"""
+import sys, os, json, hashlib, fnmatch, shutil, subprocess, stat
+LSF_COMMANDS = %(lsf_commands)r
+def walk(root):
+    folders = [""]
+    while folders:
+        folder = folders.pop()
+        for name in sorted(os.listdir(os.path.join(root, folder))):
+            rel = folder + "/" + name if folder else name
+            st = os.lstat(os.path.join(root, rel))
+            if stat.S_ISDIR(st.st_mode):
+                folders.append(rel)
+            yield rel, st
+def op_hello():
+    return {"pid": os.getpid(), "python": sys.version.split()[0]}
+def op_list(path):
+    return sorted(os.listdir(path))
+def op_delete(paths):
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+    return len(paths)
+def op_scan(root, include=None, exclude=None, max_size=None):
+    entries = []
+    for rel, st in walk(root):
+        if stat.S_ISDIR(st.st_mode):
+            entry_type = "d"
+        elif stat.S_ISLNK(st.st_mode):
+            entry_type = "l"
+        else:
+            entry_type = "f"
+            name = os.path.basename(rel)
+            if include and not any(fnmatch.fnmatchcase(name, p) for p in include):
+                continue
+            if exclude and any(fnmatch.fnmatchcase(name, p) for p in exclude):
+                continue
+            if max_size is not None and st.st_size > max_size:
+                continue
+        entries.append([entry_type, st.st_size, st.st_mtime, rel])
+    return entries
+def op_hash(root, pattern="*", paths=None):
+    digests = {}
+    if not os.path.isdir(root):
+        return digests
+    if paths is None:
+        paths = [rel for rel, st in walk(root)
+                 if stat.S_ISREG(st.st_mode) and fnmatch.fnmatch(os.path.basename(rel), pattern)]
+    for rel in paths:
+        if os.path.isfile(os.path.join(root, rel)):
+            h = hashlib.sha256()
+            f = open(os.path.join(root, rel), "rb")
+            try:
+                for block in iter(lambda: f.read(1048576), b""):
+                    h.update(block)
+            finally:
+                f.close()
+            digests[root.rstrip("/") + "/" + rel] = h.hexdigest()
+    return digests
+def op_read(paths):
+    texts = {}
+    for path in paths:
+        f = open(path)
+        try:
+            texts[path] = f.read()
+        finally:
+            f.close()
+    return texts
+def op_tail(roots, offsets, tail_bytes=None, max_bytes=65536, exclude=()):
+    chunks = []
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        for rel, st in walk(root):
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if any(fnmatch.fnmatchcase(os.path.basename(rel), p) for p in exclude):
+                continue
+            path = root.rstrip("/") + "/" + rel
+            start = offsets.get(path)
+            if start is None:
+                start = 0 if tail_bytes is None else max(0, st.st_size - tail_bytes)
+            elif start > st.st_size:
+                start = 0
+            start = max(start, st.st_size - max_bytes)
+            if start >= st.st_size:
+                continue
+            f = open(os.path.join(root, rel), "rb")
+            try:
+                f.seek(start)
+                data = f.read(st.st_size - start)
+            finally:
+                f.close()
+            chunks.append([path, start, start + len(data), data.decode("utf-8", "replace")])
+    return chunks
+def op_lsf(argv, stdin_file=None):
+    if argv[0] not in LSF_COMMANDS:
+        raise ValueError("not an lsf command: %%s" %% argv[0])
+    stdin = open(stdin_file, "rb") if stdin_file else open(os.devnull, "rb")
+    try:
+        proc = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    finally:
+        stdin.close()
+    return [proc.returncode, out.decode("utf-8", "replace"), err.decode("utf-8", "replace")]
+OPS = {"hello": op_hello, "list": op_list, "delete": op_delete,
+       "scan": op_scan, "hash": op_hash, "read": op_read, "tail": op_tail, "lsf": op_lsf}
+os.chdir(os.path.expanduser("~"))
+for line in iter(sys.stdin.readline, ""):
+    request = json.loads(line)
+    try:
+        response = {"id": request["id"], "ok": True,
+                    "result": OPS[request["op"]](**request.get("args", {}))}
+    except Exception:
+        error = sys.exc_info()[1]
+        response = {"id": request["id"], "ok": False, "error": "%%s: %%s" %% (type(error).__name__, error)}
+    sys.stdout.write(json.dumps(response) + "\n")
+    sys.stdout.flush()
+""" % {"lsf_commands": AGENT_LSF_COMMANDS}
+#Source of the summary extraction run on the cluster by extract_summary. Runs under python 2.6+ or 3.
+#Arguments are the base64 json list of rules and the folder to read. Writes one tab separated row
+#(folder, file, one value per rule) for every file a rule found something in
+EXTRACT_SOURCE = r"""
+import sys, os, io, re, json, base64, fnmatch
+rules = json.loads(base64.b64decode(sys.argv[1]).decode("utf-8"))
+root = sys.argv[2]
+out = getattr(sys.stdout, "buffer", sys.stdout)
+for rule in rules:
+    rule["regex"] = re.compile(rule["pattern"]) if rule.get("pattern") else None
+def escape(text):
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+def extract(path, file_rules):
+    values = [None]*len(rules)
+    #stop reading once every rule is past its last line
+    last = 0
+    for i, rule in file_rules:
+        if not rule.get("lines") or rule["lines"][1] is None:
+            last = None
+            break
+        last = max(last, rule["lines"][1])
+    f = io.open(path, encoding="utf-8", errors="replace")
+    try:
+        for number, line in enumerate(f, 1):
+            if last is not None and number > last:
+                break
+            line = line.rstrip("\r\n")
+            for i, rule in file_rules:
+                lines = rule.get("lines")
+                if lines and (number < lines[0] or (lines[1] is not None and number > lines[1])):
+                    continue
+                if rule["regex"] is not None:
+                    if values[i] is None:
+                        match = rule["regex"].search(line)
+                        if match:
+                            values[i] = match.group(1) if match.groups() else match.group(0)
+                else:
+                    values[i] = line if values[i] is None else values[i] + " " + line
+    finally:
+        f.close()
+    return values
+for dirpath, dirnames, filenames in os.walk(root):
+    dirnames.sort()
+    folder = os.path.relpath(dirpath, root)
+    if folder == ".":
+        folder = ""
+    for name in sorted(filenames):
+        file_rules = [(i, rule) for i, rule in enumerate(rules) if fnmatch.fnmatch(name, rule.get("files") or "*")]
+        if not file_rules:
+            continue
+        try:
+            values = extract(os.path.join(dirpath, name), file_rules)
+        except (IOError, OSError):
+            continue
+        if any(value is not None for value in values):
+            row = [folder, name] + ["" if value is None else value for value in values]
+            out.write(("\t".join(escape(value) for value in row) + "\n").encode("utf-8"))
+"""
+#Shell script used by tail_files without the remote helper. Reads "offset<tab>path" lines from stdin
+#and writes "path<tab>start<tab>base64 data" for every file that grew. Arguments are the tail bytes of
+#new files (-1 for all of them), the most bytes read per file and the folders to follow
+TAIL_SOURCE = r"""
+tail_bytes=$1 max_bytes=$2
+shift 2
+declare -A offsets
+while IFS=$'\t' read -r offset path; do offsets[$path]=$offset; done
+find "$@" -type f %(filter)s-printf '%%s\t%%p\n' | while IFS=$'\t' read -r size path; do
+    start=${offsets[$path]-}
+    if [ -z "$start" ]; then
+        start=0
+        [ $tail_bytes -ge 0 ] && [ $size -gt $tail_bytes ] && start=$((size-tail_bytes))
+    elif [ $start -gt $size ]; then
+        start=0
+    fi
+    [ $((size-max_bytes)) -gt $start ] && start=$((size-max_bytes))
+    [ $size -gt $start ] || continue
+    printf '%%s\t%%s\t' "$path" "$start"
+    tail -c +$((start+1)) "$path" | head -c $((size-start)) | base64 | tr -d '\n'
+    echo
+done
+"""
+#---------------------------------------------
+class TaskCancelled(Exception):
+    """Raised when asking for the result of a task that was cancelled before it ran"""
+    pass
+
+#---------------------------------------------
+class RemoteAgentError(Exception):
+    """Raised when the remote helper fails or is not running"""
+    pass
+
+#---------------------------------------------
+class TaskFuture:
+    """
+    Handle to a unit of work queued on the TaskScheduler.
+    Work functions receive their future as first argument and should check
+    the abort flag regularly so that long running transfers can be stopped.
+    """
+    def __init__(self, priority):
+        self.priority = priority
+        #set when cancellation was requested. Checked by running work.
+        self.abort = False
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+    def cancel(self):
+        """
+        Requests cancellation of the task.
+        A task that has not started will never run. A running task has its abort flag set.
+        Returns True if the task was cancelled before starting.
+        """
+        with self._lock:
+            self.abort = True
+            if self._started or self._finished.is_set():
+                return False
+            self._cancelled = True
+        self._finish()
+        return True
+    def cancelled(self):
+        return self._cancelled
+    def running(self):
+        return self._started and not self._finished.is_set()
+    def done(self):
+        return self._finished.is_set()
+    def result(self, timeout=None):
+        """Waits for the task and returns its result or raises its exception"""
+        if not self._finished.wait(timeout):
+            raise RuntimeError("Timed out waiting for task")
+        if self._cancelled:
+            raise TaskCancelled()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+    def exception(self, timeout=None):
+        """Waits for the task and returns the exception it raised if any"""
+        if not self._finished.wait(timeout):
+            raise RuntimeError("Timed out waiting for task")
+        return self._exception
+    def add_done_callback(self, func):
+        """
+        Calls func(future) once the task is done.
+        Called from the worker thread or immediately if the task is already done.
+        """
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+    def _start(self):
+        """Marks the task as running. Returns False if it was cancelled while queued or already taken by another worker"""
+        with self._lock:
+            if self._cancelled or self._started:
+                return False
+            self._started = True
+            return True
+    def _set_result(self, result):
+        self._result = result
+        self._finish()
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+    def _finish(self):
+        with self._lock:
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+#---------------------------------------------
+class TaskScheduler:
+    """
+    Runs queued work on a bounded pool of worker threads.
+    Tasks are started in order of priority class and then submission order,
+    so interactive queries are never stuck behind bulk transfers.
+    interactive_workers of the workers only run interactive tasks, so one is free for them
+    even while all other workers are busy with transfers.
+    """
+    def __init__(self, num_workers=MAX_CONNECTIONS, interactive_workers=INTERACTIVE_WORKERS):
+        self.num_workers = num_workers
+        self.queue = Queue.PriorityQueue()
+        #interactive tasks are also queued here. Whichever worker takes a task first runs it
+        self.interactive_queue = Queue.PriorityQueue()
+        #tie breaker so tasks with equal priority run in submission order
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        #workers by the queue they take tasks from
+        self.workers = {self.queue: [], self.interactive_queue: []}
+        self.max_workers = {self.queue: num_workers - interactive_workers,
+                            self.interactive_queue: interactive_workers}
+    def submit(self, priority, func, *args, **kwargs):
+        """
+        Queues func(future, *args, **kwargs) and returns its TaskFuture.
+        priority should be one of the PRIORITY_* classes.
+        """
+        future = TaskFuture(priority)
+        item = (priority, next(self.counter), future, func, args, kwargs)
+        self.queue.put(item)
+        self._start_worker(self.queue)
+        if priority <= PRIORITY_INTERACTIVE:
+            self.interactive_queue.put(item)
+            self._start_worker(self.interactive_queue)
+        return future
+    def _start_worker(self, queue):
+        """Starts another worker thread for queue if we are below the limit"""
+        with self.lock:
+            if len(self.workers[queue]) >= self.max_workers[queue]:
+                return
+            worker = threading.Thread(target=self._work, args=(queue,))
+            worker.daemon = True
+            self.workers[queue].append(worker)
+        worker.start()
+    def _work(self, queue):
+        while True:
+            priority, count, future, func, args, kwargs = queue.get()
+            if future is None:
+                #shutdown sentinel
+                break
+            if not future._start():
+                continue
+            try:
+                result = func(future, *args, **kwargs)
+            except Exception as e:
+                future._set_exception(e)
+            else:
+                future._set_result(result)
+    def shutdown(self):
+        """Stops all worker threads once the queued work is done"""
+        with self.lock:
+            for queue, workers in self.workers.items():
+                for worker in workers:
+                    #sentinels sort after all real work
+                    queue.put((PRIORITY_SHUTDOWN, next(self.counter), None, None, None, None))
+                self.workers[queue] = []
+
+#---------------------------------------------
+class ConnectionPool:
+    """
+    Pool of long lived authenticated transports shared by all worker threads.
+    SFTP clients and exec channels are multiplexed over a small number of transports
+    so the ssh handshake and password authentication are only done once per transport.
+    Each transport has at most MAX_SESSIONS open channels. If all are full, an idle sftp client is
+    closed to make room, otherwise opening a channel raises paramiko.ChannelException like a refusal
+    by the server, which callers retry with backoff. A refused channel never closes the transport.
+    """
+    def __init__(self, hostname, port, username, password, size=POOL_TRANSPORTS):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.lock = threading.Lock()
+        #open transports
+        self.transports = []
+        #sftp clients which are not currently used by any thread
+        self.idle_sftp = []
+        #channels opened on each transport. Closed ones are dropped when sessions are counted
+        self.channels = {}
+        #sessions handed out by get_transport that are still being opened, by transport
+        self.reserved = {}
+    def _open_transport(self):
+        """Opens and authenticates a new transport"""
+        t = paramiko.Transport((self.hostname, self.port))
+        t.use_compression()
+        #recomended window size from https://github.com/paramiko/paramiko/issues/175
+        t.window_size = 134217727
+        try:
+            t.connect(username=self.username, password=self.password)
+        except Exception:
+            t.close()
+            raise
+        t.set_keepalive(KEEPALIVE_INTERVAL)
+        return t
+    def warm(self):
+        """
+        Opens all transports of the pool.
+        Raises paramiko.AuthenticationException if the login is rejected.
+        """
+        with self.lock:
+            while len(self.transports) < self.size:
+                self.transports.append(self._open_transport())
+    def get_transport(self):
+        """
+        Returns the healthy transport with the fewest open sessions, replacing any that have died,
+        and reserves a session on it which the caller hands back with _track or _unreserve.
+        Makes room by closing an idle sftp client if every transport is full.
+        Raises paramiko.ChannelException if there is still no free session
+        """
+        with self.lock:
+            for t in [t for t in self.transports if not is_alive(t)]:
+                self._remove_transport(t)
+                t.close()
+            while len(self.transports) < self.size:
+                self.transports.append(self._open_transport())
+            t = min(self.transports, key=self._count_sessions)
+            if self._count_sessions(t) >= MAX_SESSIONS and self.idle_sftp:
+                sftp = self.idle_sftp.pop(0)
+                sftp.close()
+                t = sftp.get_channel().get_transport()
+            if self._count_sessions(t) >= MAX_SESSIONS:
+                raise paramiko.ChannelException(paramiko.common.OPEN_FAILED_RESOURCE_SHORTAGE,
+                                                "All sessions of the pooled transports are in use")
+            self.reserved[t] = self.reserved.get(t, 0) + 1
+            return t
+    def discard_transport(self, t):
+        """Removes a broken transport from the pool so it gets replaced"""
+        with self.lock:
+            self._remove_transport(t)
+        t.close()
+    def _remove_transport(self, t):
+        if t in self.transports:
+            self.transports.remove(t)
+        self.channels.pop(t, None)
+        self.reserved.pop(t, None)
+        self.idle_sftp = [sftp for sftp in self.idle_sftp
+                          if sftp.get_channel().get_transport() is not t]
+    def _count_sessions(self, t):
+        channels = [chan for chan in self.channels.get(t, ()) if not chan.closed]
+        self.channels[t] = channels
+        return len(channels) + self.reserved.get(t, 0)
+    def _track(self, t, chan):
+        """Turns the session reserved on t into the open channel chan"""
+        with self.lock:
+            self._unreserve(t)
+            self.channels.setdefault(t, []).append(chan)
+    def _unreserve(self, t):
+        if self.reserved.get(t):
+            self.reserved[t] -= 1
+    def _open(self, open_func):
+        """
+        Calls open_func(transport) on a transport with a free session and returns the new channel or client.
+        A transport that fails for any other reason than a refused channel is replaced and the call tried once more
+        """
+        t = self.get_transport()
+        try:
+            return t, open_func(t)
+        except paramiko.ChannelException:
+            #the server has no session for us right now, the transport itself is fine
+            with self.lock:
+                self._unreserve(t)
+            raise
+        except (paramiko.SSHException, EOFError, socket.error):
+            #transport went away underneath us. Try once more on a fresh one
+            self.discard_transport(t)
+        t = self.get_transport()
+        try:
+            return t, open_func(t)
+        except Exception:
+            with self.lock:
+                self._unreserve(t)
+            raise
+    def open_session(self):
+        """
+        Opens a new session channel on one of the pooled transports.
+        Raises paramiko.ChannelException if no session is free so the caller can back off and retry
+        """
+        t, chan = self._open(lambda t: t.open_session())
+        self._track(t, chan)
+        return chan
+    def _acquire_sftp(self):
+        with self.lock:
+            while self.idle_sftp:
+                sftp = self.idle_sftp.pop()
+                if sftp_is_alive(sftp):
+                    return sftp
+                sftp.close()
+        #wait for a free session with backoff like RemoteExecutor does for commands
+        delay = COMMAND_BACKOFF
+        for attempt in itertools.count():
+            try:
+                t, sftp = self._open(paramiko.SFTPClient.from_transport)
+            except paramiko.ChannelException:
+                if attempt >= COMMAND_RETRIES:
+                    raise
+                time.sleep(delay*random.uniform(0.5, 1.5))
+                delay *= 2
+                continue
+            self._track(t, sftp.get_channel())
+            return sftp
+    def _release_sftp(self, sftp):
+        with self.lock:
+            if sftp_is_alive(sftp) and len(self.idle_sftp) < POOL_IDLE_SFTP:
+                self.idle_sftp.append(sftp)
+                return
+        sftp.close()
+    @contextmanager
+    def sftp(self):
+        """
+        Context manager that lends out a pooled sftp client.
+        The client is handed back to the pool when the block exits.
+        """
+        sftp = self._acquire_sftp()
+        try:
+            yield sftp
+        finally:
+            self._release_sftp(sftp)
+    def close(self):
+        """Closes all sftp clients and transports"""
+        with self.lock:
+            for sftp in self.idle_sftp:
+                sftp.close()
+            for t in self.transports:
+                t.close()
+            self.idle_sftp = []
+            self.transports = []
+            self.channels = {}
+            self.reserved = {}
+
+#---------------------------------------------
+class RemoteExecutor:
+    """
+    Runs all remote commands of the app over the connection pool.
+    Commands are rate limited with a token bucket and the number of commands running at once is capped
+    so we do not get blocked by the login node. Long running streams have their own cap. Channels the server refuses are retried with
+    exponential backoff and the rate is halved, then slowly raised again as commands succeed.
+    Identical read only commands that are in flight at the same time can share one call.
+    """
+    def __init__(self, pool, rate=COMMAND_RATE, burst=COMMAND_BURST, max_commands=MAX_COMMANDS,
+                 retries=COMMAND_RETRIES, max_streams=MAX_STREAMS):
+        self.pool = pool
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_commands)
+        self.stream_slots = threading.BoundedSemaphore(max_streams)
+        #token bucket
+        self.tokens = float(burst)
+        self.last_fill = time.time()
+        #futures of coalesced commands that are running by command
+        self.in_flight = {}
+    def _take_token(self):
+        """Waits until the rate limit allows another command"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_fill)*self.rate)
+                self.last_fill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+    def _exec(self, command):
+        """Opens a channel and starts command on it, retrying refused channels with backoff"""
+        delay = COMMAND_BACKOFF
+        for attempt in itertools.count():
+            self._take_token()
+            chan = None
+            try:
+                chan = self.pool.open_session()
+                chan.exec_command(command)
+            except paramiko.AuthenticationException:
+                raise
+            except (paramiko.SSHException, EOFError, socket.error):
+                if chan is not None:
+                    chan.close()
+                with self.lock:
+                    self.rate = max(COMMAND_MIN_RATE, self.rate/2)
+                if attempt >= self.retries:
+                    raise
+                time.sleep(delay*random.uniform(0.5, 1.5))
+                delay *= 2
+                continue
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate/20)
+            return chan
+    def open_channel(self, command):
+        """
+        Starts command on a channel that is closed by the caller.
+        Used for long lived channels so they do not take up one of the command slots.
+        """
+        return self._exec(command)
+    @contextmanager
+    def open(self, command, stream=False):
+        """
+        Context manager that runs command and yields its channel for streaming input and output.
+        The channel is closed and its slot freed when the block exits.
+        Use stream for commands that run as long as a transfer so they take a stream slot instead of a command slot.
+        """
+        with self.stream_slots if stream else self.slots:
+            chan = self._exec(command)
+            try:
+                yield chan
+            finally:
+                chan.close()
+    def run(self, command, data=None, coalesce=False):
+        """
+        Runs command, optionally sending data to its stdin, and returns a CommandResult once it exits.
+        With coalesce a call for a command that is already running waits for and shares its result.
+        Only use coalesce for commands without side effects.
+        """
+        if not coalesce:
+            return self._run(command, data)
+        with self.lock:
+            future = self.in_flight.get(command)
+            owner = future is None
+            if owner:
+                future = TaskFuture(PRIORITY_INTERACTIVE)
+                future._start()
+                self.in_flight[command] = future
+        if not owner:
+            return future.result()
+        try:
+            result = self._run(command, data)
+        except Exception as e:
+            future._set_exception(e)
+            raise
+        else:
+            future._set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[command]
+    def _run(self, command, data):
+        with self.open(command) as chan:
+            if data is not None:
+                chan.sendall(to_bytes(data))
+                chan.shutdown_write()
+            stdout = to_text(chan.makefile('rb', -1).read())
+            stderr = to_text(chan.makefile_stderr('rb', -1).read())
+            return CommandResult(chan.recv_exit_status(), stdout, stderr)
+
+#---------------------------------------------
+class RemoteAgent:
+    """
+    Client of a small python helper kept running on the cluster over one channel.
+    Requests are json lines tagged with an id so many can be in flight at once,
+    which saves starting a channel and login shell for every operation.
+    """
+    def __init__(self, executor):
+        self.executor = executor
+        self.chan = None
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        #futures waiting for a response by request id
+        self.pending = {}
+        self.alive = False
+    def start(self):
+        """
+        Starts the helper under a login shell so LSF commands are on the path.
+        Raises RemoteAgentError if the helper does not come up.
+        """
+        source = to_text(base64.b64encode(to_bytes(AGENT_SOURCE)))
+        self.chan = self.executor.open_channel(
+            "bash -lc 'PY=$(command -v python3 || command -v python) && "
+            "exec \"$PY\" -u -c \"import base64; exec(base64.b64decode(\\\"{}\\\"))\"'".format(source))
+        self.alive = True
+        reader = threading.Thread(target=self._read_responses)
+        reader.daemon = True
+        reader.start()
+        try:
+            return self.call("hello", timeout=AGENT_START_TIMEOUT)
+        except Exception:
+            self.close()
+            raise RemoteAgentError("Remote helper did not start")
+    def request(self, op, **args):
+        """Sends a request without waiting for it and returns a TaskFuture for the result"""
+        future = TaskFuture(PRIORITY_INTERACTIVE)
+        future._start()
+        with self.lock:
+            if not self.alive:
+                raise RemoteAgentError("Remote helper is not running")
+            request_id = next(self.counter)
+            self.pending[request_id] = future
+            try:
+                self.chan.sendall(to_bytes(json.dumps({"id": request_id, "op": op, "args": args}) + "\n"))
+            except (socket.error, EOFError, paramiko.SSHException) as e:
+                del self.pending[request_id]
+                raise RemoteAgentError("Remote helper connection lost ({})".format(e))
+        return future
+    def call(self, op, timeout=None, **args):
+        """Sends a request and waits for its result"""
+        return self.request(op, **args).result(timeout)
+    def _read_responses(self):
+        """Hands responses to the waiting futures until the channel closes"""
+        try:
+            for line in self.chan.makefile("rb", -1):
+                try:
+                    response = json.loads(to_text(line))
+                except ValueError:
+                    continue
+                with self.lock:
+                    future = self.pending.pop(response.get("id"), None)
+                if future is None:
+                    continue
+                if response.get("ok"):
+                    future._set_result(response.get("result"))
+                else:
+                    future._set_exception(RemoteAgentError(response.get("error")))
+        except (socket.error, EOFError, paramiko.SSHException):
+            pass
+        with self.lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future._set_exception(RemoteAgentError("Remote helper exited"))
+    def close(self):
+        with self.lock:
+            self.alive = False
+        if self.chan is not None:
+            self.chan.close()
+
+#---------------------------------------------
+class StatusPoller:
+    """
+    Polls the job list in the background and keeps a table of jobs keyed by job id.
+    Only the jobs that were added, changed or removed since the last poll are reported
+    with diff_func(added, changed, removed), which is called from the poller thread.
+    """
+    def __init__(self, fetch_func, diff_func, interval=STATUS_POLL_INTERVAL, error_func=None):
+        self.fetch_func = fetch_func
+        self.diff_func = diff_func
+        self.interval = interval
+        self.error_func = error_func
+        self.lock = threading.Lock()
+        #JobRecords by job id as of the last poll
+        self.jobs = collections.OrderedDict()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+    def start(self):
+        """Starts polling. The first poll happens right away"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+    def poll_now(self):
+        """Asks for a poll without waiting for the interval"""
+        self.wake.set()
+    def running(self):
+        return self.thread is not None and not self.stopped.is_set()
+    def update(self, records):
+        """
+        Replaces the job table with records.
+        Returns lists of the added, changed and removed JobRecords
+        """
+        with self.lock:
+            jobs = collections.OrderedDict((record.jobid, record) for record in records)
+            added = [record for jobid, record in jobs.items() if jobid not in self.jobs]
+            changed = [record for jobid, record in jobs.items()
+                       if jobid in self.jobs and self.jobs[jobid] != record]
+            removed = [record for jobid, record in self.jobs.items() if jobid not in jobs]
+            self.jobs = jobs
+        return added, changed, removed
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wake.clear()
+            try:
+                added, changed, removed = self.update(self.fetch_func())
+            except Exception as e:
+                if self.error_func:
+                    self.error_func(e)
+            else:
+                if added or changed or removed:
+                    self.diff_func(added, changed, removed)
+            self.wake.wait(self.interval)
+
+#---------------------------------------------
+class OutputFollower:
+    """
+    Follows the files written by a running job like tail -f.
+    Keeps the byte offset each file was read up to and on every poll only the bytes appended since
+    are fetched, for all files with one call. data_func(path, text) receives the new text of each file
+    and is called from the follower thread.
+    """
+    def __init__(self, fetch_func, data_func, interval=FOLLOW_POLL_INTERVAL, error_func=None):
+        #fetch_func(offsets, tail_bytes) returns (path, start, end, text) for every file that grew
+        self.fetch_func = fetch_func
+        self.data_func = data_func
+        self.interval = interval
+        self.error_func = error_func
+        #offset read up to by path
+        self.offsets = {}
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+    def start(self):
+        """Starts following. The end of the existing files is read right away"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+    def poll_now(self):
+        """Asks for a poll without waiting for the interval"""
+        self.wake.set()
+    def running(self):
+        return self.thread is not None and not self.stopped.is_set()
+    def poll(self, tail_bytes=None):
+        """
+        Fetches what was appended to the followed files and hands it to data_func.
+        Files seen for the first time are read from the start, or only their last tail_bytes if given
+        """
+        for path, start, end, text in self.fetch_func(dict(self.offsets), tail_bytes):
+            self.offsets[path] = end
+            if text and not self.stopped.is_set():
+                self.data_func(path, text)
+    def _run(self):
+        tail_bytes = FOLLOW_TAIL_BYTES
+        while not self.stopped.is_set():
+            self.wake.clear()
+            try:
+                self.poll(tail_bytes)
+            except Exception as e:
+                if self.error_func:
+                    self.error_func(e)
+            else:
+                #files that show up later are shown from their start
+                tail_bytes = None
+            self.wake.wait(self.interval)
+
+#---------------------------------------------
+class LogBuffer:
+    """
+    Bounded thread safe buffer for the app's output.
+    write can be given to CEPACClusterApp.bind_output so worker threads only append to the buffer,
+    and the GUI takes the new lines with drain in batches. Once the buffer is full the oldest
+    undrained lines are dropped. If spill_path is given every line is also kept in a rotating log file.
+    """
+    def __init__(self, max_lines=LOG_BUFFER_LINES, spill_path=None,
+                 spill_bytes=LOG_SPILL_BYTES, spill_backups=LOG_SPILL_BACKUPS):
+        self.lock = threading.Lock()
+        self.lines = collections.deque(maxlen=max_lines)
+        #lines dropped since the last drain
+        self.dropped = 0
+        self.spill = None
+        if spill_path:
+            if not os.path.isdir(os.path.dirname(spill_path)):
+                os.makedirs(os.path.dirname(spill_path))
+            #one logger per log file so buffers spilling to different files never share a handler,
+            #while buffers spilling to the same file share one and don't rotate it twice
+            spill_key = hashlib.sha1(to_bytes(os.path.normcase(os.path.abspath(spill_path)))).hexdigest()
+            self.spill = logging.getLogger("cepac_cluster_tool.output." + spill_key)
+            self.spill.propagate = False
+            self.spill.setLevel(logging.INFO)
+            if not self.spill.handlers:
+                handler = logging.handlers.RotatingFileHandler(spill_path, maxBytes=spill_bytes,
+                                                               backupCount=spill_backups)
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                self.spill.addHandler(handler)
+    def write(self, text, is_thread=True):
+        """Adds text to the buffer. Has the signature of the output functions so it can be bound directly"""
+        lines = to_text(text).split("\n")
+        with self.lock:
+            overflow = len(self.lines) + len(lines) - self.lines.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self.lines.extend(lines)
+        if self.spill:
+            for line in lines:
+                self.spill.info(line)
+    def drain(self, max_lines=None):
+        """
+        Removes and returns up to max_lines of the oldest lines in the buffer
+        together with the number of lines dropped since the last drain
+        """
+        with self.lock:
+            count = len(self.lines) if max_lines is None else min(max_lines, len(self.lines))
+            lines = [self.lines.popleft() for i in range(count)]
+            dropped, self.dropped = self.dropped, 0
+        return lines, dropped
+
+#---------------------------------------------
+class Transfer:
+    """
+    Byte counts of one upload or download registered with a ProgressTracker.
+    add is meant to be used as the byte callback of the transfer code.
+    """
+    def __init__(self, tracker, name, total_bytes, func=None):
+        self.tracker = tracker
+        self.name = name
+        self.total_bytes = total_bytes
+        #called with a ProgressInfo on every report of this transfer
+        self.func = func
+        self.done_bytes = 0
+        self.start_time = time.time()
+        self.last_report = 0
+        self.last_bytes = 0
+        self.throughput = 0.0
+        self.rate = None
+        #set once the transfer finished successfully
+        self.completed = False
+    def add(self, num_bytes):
+        """Counts num_bytes more as transferred"""
+        self.tracker._add(self, num_bytes)
+    def sftp_callback(self):
+        """Returns a callback for paramiko's sftp put/get which report the bytes sent so far of a file"""
+        sent = [0]
+        def callback(so_far, total):
+            self.add(so_far - sent[0])
+            sent[0] = so_far
+        return callback
+    def add_total(self, num_bytes):
+        """Counts num_bytes more to transfer, for transfers whose size is found while they run"""
+        self.tracker._add_total(self, num_bytes)
+    def reset(self, total_bytes=None):
+        """
+        Starts counting from zero again, e.g. when falling back to another transfer method.
+        total_bytes replaces the size of the transfer if given.
+        """
+        self.tracker._reset(self, total_bytes)
+    def finish(self, completed=True):
+        """Reports the final state and removes the transfer from the tracker"""
+        self.tracker._finish(self, completed)
+    def info(self):
+        if self.total_bytes:
+            percent = min(self.done_bytes*100.0/self.total_bytes, 100)
+        else:
+            #nothing to transfer
+            percent = 100.0 if self.completed else 0.0
+        eta = None
+        if self.rate:
+            eta = max(self.total_bytes - self.done_bytes, 0)/self.rate
+        return ProgressInfo(self.name, self.done_bytes, self.total_bytes,
+                            percent, self.throughput, self.rate or 0.0, eta)
+
+#---------------------------------------------
+class ProgressTracker:
+    """
+    Keeps byte based progress of all running transfers.
+    Reports of a transfer are limited to one per interval seconds and carry its throughput,
+    moving average rate and ETA. Subscribers get every report together with the totals of
+    all running transfers as subscriber(info, aggregate). Reports come from the transfer threads.
+    """
+    def __init__(self, interval=PROGRESS_INTERVAL, smoothing=PROGRESS_SMOOTHING):
+        self.interval = interval
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.transfers = []
+        self.subscribers = []
+    def subscribe(self, func):
+        self.subscribers.append(func)
+    def unsubscribe(self, func):
+        if func in self.subscribers:
+            self.subscribers.remove(func)
+    def start(self, name, total_bytes, func=None):
+        """Registers a transfer of total_bytes and returns its Transfer. func(info) gets its reports"""
+        transfer = Transfer(self, name, total_bytes, func)
+        with self.lock:
+            self.transfers.append(transfer)
+        self._report(transfer)
+        return transfer
+    def aggregate(self):
+        """Returns the ProgressInfo of all running transfers together"""
+        with self.lock:
+            infos = [transfer.info() for transfer in self.transfers]
+        done_bytes = sum(info.done_bytes for info in infos)
+        total_bytes = sum(info.total_bytes for info in infos)
+        rate = sum(info.rate for info in infos)
+        eta = None
+        if rate and infos:
+            eta = max(total_bytes - done_bytes, 0)/rate
+        return ProgressInfo("all", done_bytes, total_bytes, min(done_bytes*100.0/max(total_bytes, 1), 100),
+                            sum(info.throughput for info in infos), rate, eta)
+    def _add(self, transfer, num_bytes):
+        now = time.time()
+        with self.lock:
+            transfer.done_bytes += num_bytes
+            elapsed = now - transfer.last_report
+            if elapsed < self.interval:
+                return
+            if transfer.last_report:
+                transfer.throughput = (transfer.done_bytes - transfer.last_bytes)/elapsed
+                if transfer.rate is None:
+                    transfer.rate = transfer.throughput
+                else:
+                    transfer.rate += self.smoothing*(transfer.throughput - transfer.rate)
+            transfer.last_report = now
+            transfer.last_bytes = transfer.done_bytes
+        self._report(transfer)
+    def _add_total(self, transfer, num_bytes):
+        with self.lock:
+            transfer.total_bytes += num_bytes
+    def _reset(self, transfer, total_bytes=None):
+        with self.lock:
+            transfer.done_bytes = transfer.last_bytes = 0
+            if total_bytes is not None:
+                transfer.total_bytes = total_bytes
+        self._report(transfer)
+    def _finish(self, transfer, completed):
+        with self.lock:
+            if completed:
+                transfer.completed = True
+                transfer.done_bytes = max(transfer.done_bytes, transfer.total_bytes)
+            if transfer in self.transfers:
+                self.transfers.remove(transfer)
+        self._report(transfer)
+    def _report(self, transfer):
+        info = transfer.info()
+        if transfer.func:
+            transfer.func(info)
+        if self.subscribers:
+            aggregate = self.aggregate()
+            for func in list(self.subscribers):
+                func(info, aggregate)
+
+#---------------------------------------------
+class ParallelTransfer:
+    """
+    Runs the file transfers of a folder on several threads at the same time.
+    Each thread borrows its own sftp client from the pool so the transfers are spread
+    over separate channels and transports.
+    """
+    def __init__(self, pool, task, concurrency=TRANSFER_CONCURRENCY):
+        self.pool = pool
+        self.task = task
+        self.concurrency = max(1, int(concurrency))
+    def run(self, jobs):
+        """
+        Calls job(sftp) for every job in jobs and stops early if the task is aborted.
+        jobs may be a generator which is then read as the threads become free.
+        The first error raised by a job is raised again once all threads have stopped.
+        With a concurrency of 1 the jobs are run one at a time on the calling thread
+        """
+        num_threads = self.concurrency
+        if isinstance(jobs, (list, tuple)):
+            num_threads = min(num_threads, len(jobs))
+        jobs = iter(jobs)
+        lock = threading.Lock()
+        errors = []
+        def worker():
+            try:
+                with self.pool.sftp() as sftp:
+                    while not errors and not self.task.abort:
+                        with lock:
+                            job = next(jobs, None)
+                        if job is None:
+                            return
+                        job(sftp)
+            except Exception as e:
+                errors.append(e)
+        if num_threads <= 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker) for i in range(num_threads)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+#---------------------------------------------
+class UploadPipeline:
+    """
+    Staged scan of a local folder for upload.
+    A walker thread finds the matching files and skips those the manifest knows are uploaded,
+    a pool of hashing threads drops files whose copy on the cluster has the same digest,
+    and the files left are handed out by files() as soon as they qualify.
+    The stages are connected by bounded queues so memory stays flat and transfers start with the first file.
+    """
+    def __init__(self, app, task, dir_local, remote_base, glob_pattern, manifest, transfer,
+                 num_hashers=HASH_WORKERS, queue_size=PIPELINE_QUEUE_SIZE):
+        self.app = app
+        self.task = task
+        self.dir_local = dir_local
+        self.remote_base = remote_base
+        self.glob_pattern = glob_pattern
+        self.manifest = manifest
+        self.remote_key = app.remote_key(remote_base)
+        #files to upload are added to the size of transfer as they qualify
+        self.transfer = transfer
+        self.num_hashers = num_hashers
+        #(local file, remote file) found by the walker
+        self.check_queue = Queue.Queue(queue_size)
+        #(local file, remote file) that have to be uploaded. None marks the end of a hashing thread
+        self.upload_queue = Queue.Queue(queue_size)
+        #remote folders that get a job file and their estimated work
+        self.job_dirs = []
+        self.job_work = {}
+        #job files to submit. Set by remote_files
+        self.jobfiles = None
+        #digests of the files already on the cluster. Only fetched if the manifest is not enough
+        self._remote_digests = None
+        self._digest_lock = threading.Lock()
+        self.errors = []
+        self.stopped = False
+        self.threads = []
+    def start(self):
+        self.threads = [threading.Thread(target=self._walk)]
+        self.threads += [threading.Thread(target=self._check) for i in range(self.num_hashers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+    def stop(self):
+        """Stops all stages, e.g. when the transfer failed or was aborted"""
+        self.stopped = True
+        for thread in self.threads:
+            thread.join()
+    def files(self):
+        """
+        Generates tuples (local file, remote file) of the files to upload as they qualify.
+        Errors of the stages are raised once all files are out.
+        """
+        running = self.num_hashers
+        while running:
+            item = self._get(self.upload_queue)
+            if item is None:
+                if self._halted():
+                    break
+                running -= 1
+                continue
+            yield item
+        if self.errors:
+            raise self.errors[0]
+    def remote_files(self, lsfinfo):
+        """
+        Generates the job files as tuples (remote file, text) once the walk is done
+        and sets jobfiles to the job files to submit. Read after files()
+        """
+        remote_files, self.jobfiles = self.app.build_jobfiles(self.remote_base, self.job_dirs,
+                                                              lsfinfo, self.job_work)
+        for item in remote_files:
+            yield item
+    def _halted(self):
+        return self.stopped or self.task.abort
+    def _put(self, queue, item):
+        """Puts item on a bounded queue. Returns False if the pipeline stopped while waiting"""
+        while not self._halted():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def _get(self, queue):
+        """Takes the next item from a queue. Returns None if the pipeline stopped while waiting"""
+        while not self._halted():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return None
+    def _walk(self):
+        """Walker stage. Finds the matching files of every folder below dir_local"""
+        try:
+            for dirpath, filenames in walk_files(self.dir_local):
+                if self._halted():
+                    break
+                matching_files = [os.path.join(dirpath, fname) for fname in filenames
+                                  if glob_match(fname, self.glob_pattern)]
+                if not matching_files:
+                    continue
+
+                # Fix foldername
+                if not os.path.relpath(dirpath, self.dir_local)=='.':
+                    curr_dir_remote = self.remote_base + '/' + os.path.relpath(dirpath, self.dir_local).replace("\\","/")
+                else:
+                    curr_dir_remote = self.remote_base
+                self.job_work[curr_dir_remote] = sum(PACK_FILE_WORK + os.path.getsize(f) for f in matching_files)
+                self.job_dirs.append(curr_dir_remote)
+
+                for local_file in matching_files:
+                    # unchanged since it was last uploaded here. Only needs a stat
+                    digest = self.manifest.lookup(local_file)
+                    if digest is not None and self.manifest.uploaded(self.remote_key, local_file) == digest:
+                        continue
+                    if not self._put(self.check_queue, (local_file, curr_dir_remote + '/' + os.path.basename(local_file))):
+                        return
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            #one end marker for each hashing thread
+            for i in range(self.num_hashers):
+                self._put(self.check_queue, None)
+    def _check(self):
+        """Hashing stage. Compares files that have a copy on the cluster by digest"""
+        try:
+            while True:
+                item = self._get(self.check_queue)
+                if item is None:
+                    break
+                local_file, remote_file = item
+                remote_digests = self._get_remote_digests()
+                # only hash the local file if there is a remote copy to compare with
+                if remote_file in remote_digests and self.manifest.digest(local_file) == remote_digests[remote_file]:
+                    self.manifest.mark_uploaded(self.remote_key, local_file, remote_digests[remote_file])
+                    continue
+                self.transfer.add_total(os.path.getsize(local_file))
+                if not self._put(self.upload_queue, item):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self._put(self.upload_queue, None)
+    def _get_remote_digests(self):
+        """Fetches the digests of the remote copies with one call when the first file needs them"""
+        with self._digest_lock:
+            if self._remote_digests is None:
+                self._remote_digests = self.app.remote_digests(self.remote_base, self.glob_pattern)
+            return self._remote_digests
+
+#---------------------------------------------
+class SummaryTable:
+    """
+    Columnar table of the values extracted from run outputs by extract_summary.
+    Has a run_folder and file column followed by one column per extraction rule.
+    Missing values are empty strings.
+    """
+    def __init__(self, field_names):
+        self.columns = ["run_folder", "file"] + list(field_names)
+        #column name -> list of values
+        self.data = dict((name, []) for name in self.columns)
+    def __len__(self):
+        return len(self.data["file"])
+    def add_row(self, row):
+        for name, value in zip(self.columns, row):
+            self.data[name].append(value)
+    def rows(self):
+        """Returns the table as a list of row tuples"""
+        return list(zip(*[self.data[name] for name in self.columns]))
+    def write_csv(self, path):
+        """Writes the table with a header row to a csv file"""
+        if sys.version_info[0] < 3:
+            f = open(path, "wb")
+            encode = lambda row: [to_bytes(value) for value in row]
+        else:
+            f = open(path, "w", newline="")
+            encode = lambda row: row
+        with f:
+            writer = csv.writer(f)
+            writer.writerow(encode(self.columns))
+            for row in self.rows():
+                writer.writerow(encode(row))
+
+#---------------------------------------------
+class CountingReader:
+    """
+    Wraps a file object and reports the number of bytes read to a callback.
+    Also hashes the data as it passes so files don't need to be read twice.
+    """
+    def __init__(self, f, callback):
+        self.f = f
+        self.callback = callback
+        self.sha = hashlib.sha256()
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha.update(data)
+        self.callback(len(data))
+        return data
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+#---------------------------------------------
+class InputManifest:
+    """
+    Persistent on disk manifest of a local input folder.
+    Maps each file to (size, mtime, digest) so unchanged files are recognised with a stat only,
+    and records which digest was last uploaded to each cluster/run folder.
+    """
+    def __init__(self, root, cache_dir=CACHE_DIR):
+        self.root = os.path.abspath(root)
+        key = hashlib.sha1(to_bytes(os.path.normcase(self.root))).hexdigest()
+        self.path = os.path.join(cache_dir, "manifests", key + ".json")
+        #relative path -> [size, mtime, digest]
+        self.files = {}
+        #remote key -> {relative path: digest}
+        self.uploads = {}
+        #the upload pipeline records digests from several threads
+        self.lock = threading.Lock()
+        self.load()
+    def load(self):
+        """Reads the manifest from disk. A missing or damaged manifest starts out empty"""
+        data = read_json(self.path)
+        if data and data.get("root") == self.root:
+            self.files = data.get("files", {})
+            self.uploads = data.get("uploads", {})
+    def save(self):
+        save_json(self.path, self.lock, lambda: {
+            "root": self.root, "files": dict(self.files),
+            "uploads": dict((key, dict(files)) for key, files in self.uploads.items())})
+    def _relpath(self, path):
+        return os.path.relpath(path, self.root).replace("\\", "/")
+    def lookup(self, path):
+        """Returns the cached digest of path if it is unchanged since it was hashed, otherwise None"""
+        entry = self.files.get(self._relpath(path))
+        st = os.stat(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        return None
+    def digest(self, path):
+        """Returns the digest of path, only reading the file if it changed"""
+        digest = self.lookup(path)
+        if digest is None:
+            digest = file_digest(path)
+            self.record(path, digest)
+        return digest
+    def record(self, path, digest):
+        """Stores the digest of path together with its current size and mtime"""
+        st = os.stat(path)
+        with self.lock:
+            self.files[self._relpath(path)] = [st.st_size, st.st_mtime, digest]
+    def uploaded(self, remote_key, path):
+        """Returns the digest last uploaded from path to the remote folder or None"""
+        return self.uploads.get(remote_key, {}).get(self._relpath(path))
+    def mark_uploaded(self, remote_key, path, digest):
+        with self.lock:
+            self.uploads.setdefault(remote_key, {})[self._relpath(path)] = digest
+
+#---------------------------------------------
+class MetadataCache:
+    """
+    Persistent on disk cache of cluster information such as model versions, queues and run folders.
+    There is one cache per cluster and user. Each entry keeps the time it was fetched
+    so callers can decide if it is still fresh.
+    """
+    def __init__(self, key, cache_dir=CACHE_DIR):
+        self.key = key
+        self.path = os.path.join(cache_dir, "metadata", hashlib.sha1(to_bytes(key)).hexdigest() + ".json")
+        #name -> [fetch time, value]
+        self.entries = {}
+        #names being refreshed in the background
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.load()
+    def load(self):
+        """Reads the cache from disk. A missing or damaged cache starts out empty"""
+        data = read_json(self.path)
+        if data and data.get("key") == self.key:
+            self.entries = data.get("entries", {})
+    def save(self):
+        save_json(self.path, self.lock, lambda: {"key": self.key, "entries": dict(self.entries)})
+    def get(self, name, max_age):
+        """Returns (value, fresh). value is None if name is not cached"""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None:
+            return None, False
+        return entry[1], 0 <= time.time() - entry[0] < max_age
+    def put(self, name, value):
+        with self.lock:
+            self.entries[name] = [time.time(), value]
+        self.save()
+    def invalidate(self, *names):
+        """Drops names from the cache so they are fetched again on next use"""
+        with self.lock:
+            found = [self.entries.pop(name) for name in names if name in self.entries]
+        if found:
+            self.save()
+    def start_refresh(self, name):
+        """Returns False if name is already being refreshed"""
+        with self.lock:
+            if name in self.refreshing:
+                return False
+            self.refreshing.add(name)
+            return True
+    def end_refresh(self, name):
+        with self.lock:
+            self.refreshing.discard(name)
+
+#---------------------------------------------
+class CEPACClusterApp:
+    """Basic class for the desktop interface with the CEPAC cluster"""
+    def __init__(self,):
+        self.port = 22
+
+        #Pool of ssh connections. Created on connect
+        self.pool = None
+        #Rate limited executor all remote commands go through. Created on connect
+        self.executor = None
+        #Optional helper running on the cluster. Used instead of shell commands while it is alive
+        self.agent = None
+
+        #Dictionary of available model versions with model type as keys
+        self.model_versions = None
+        #List of available run queues
+        self.queues = None
+        #Runs uploads, downloads and queries on a bounded number of workers
+        self.scheduler = TaskScheduler(MAX_CONNECTIONS)
+        #future of the current upload
+        self.upload_task = None
+        #futures of queued and running downloads, cancelled when the connection is closed
+        self.download_tasks = []
+        #run folders of job array elements by map file
+        self.job_maps = {}
+        #background job status poller. Created by start_status_poller
+        self.status_poller = None
+        #byte based progress of all uploads and downloads
+        self.progress = ProgressTracker()
+        #cached model versions, queues and run folders of the current cluster. Created by connect
+        self.cache = None
+        #files of a folder transferred at the same time
+        self.transfer_concurrency = TRANSFER_CONCURRENCY
+        #follower of the output of a running job. Created by follow_job
+        self.follower = None
+    def bind_output(self, output=print):
+        """
+        output is a function used to write messages from the app.
+        Defaults to the print function for the console version.
+        Any calls to print should use the self.output function instead
+        """
+        self.output = output
+        
+        #print initiation message
+        self.output("="*40, False)
+        self.output("Initiating Cepac Cluster App", False)
+    def connect(self, hostname='erisone.partners.org',
+                username=None, password=None,
+                run_path=None, model_path=None, clustername=None, use_agent=False, discover=True):
+        """
+        Starts connection to host.
+        Should be called once per client.
+        use_agent starts a helper on the cluster that handles listings, hashing, folder changes
+        and LSF queries over one channel instead of a shell command each.
+        discover loads the model versions and queues before returning.
+        Returns True if the login succeeded.
+        """
+        #Close any previous connections
+        self.close_connection()
+        
+        #Need to convert to string for paramiko because input could be unicode
+        self.hostname = str(hostname)
+        self.username = str(username)
+        self.password = str(password)
+        self.run_path = str(run_path)
+        self.model_path = str(model_path)
+        self.clustername = str(clustername)
+
+        self.output("\nConnecting to {} as user: {}...".format(self.hostname, self.username), False)
+
+        self.pool = ConnectionPool(self.hostname, self.port, self.username, self.password)
+        self.executor = RemoteExecutor(self.pool)
+        try:
+            #Open the pooled transports up front so workers never pay for the handshake
+            self.pool.warm()
+        except paramiko.AuthenticationException:
+            #Login failed
+            self.output("\tLogin Failed", False)
+            return False
+        #Get model and queue information
+        self.output("\tLogin Succesful", False)
+        self.cache = MetadataCache("{}@{}".format(username, hostname))
+        if use_agent:
+            self.start_agent()
+        if discover:
+            self.update_cluster_information()
+        return True
+    def create_connect_task(self, hostname, username, password, run_path, model_path, clustername,
+                            connected_func, info_func, use_agent=False):
+        """
+        Queues login to the cluster. Returns the TaskFuture.
+        connected_func(success) is called as soon as the login succeeded or failed.
+        Model versions and queues are then loaded at the same time and info_func() is called
+        after each of them arrives. Both functions are called from worker threads.
+        """
+        def connect_task(task):
+            try:
+                success = self.connect(hostname, username, password, run_path, model_path, clustername,
+                                       use_agent, discover=False)
+            except Exception as e:
+                self.output("\tLogin Failed ({})".format(e))
+                success = False
+            connected_func(success)
+            if success:
+                for func in (self.update_model_versions, self.update_queues):
+                    #info_func is also called when stale cached information has been refreshed
+                    future = self.submit(PRIORITY_INTERACTIVE, lambda task, func=func: func(info_func))
+                    future.add_done_callback(lambda future: info_func())
+            return success
+        return self.submit(PRIORITY_INTERACTIVE, connect_task)
+    def start_agent(self):
+        """Starts the remote helper. Shell commands are used if it cannot be started"""
+        agent = RemoteAgent(self.executor)
+        try:
+            info = agent.start()
+        except RemoteAgentError as e:
+            self.output("\t{}, using shell commands".format(e), False)
+            return
+        self.agent = agent
+        self.output("\tStarted remote helper (python {})".format(info["python"]), False)
+    def agent_call(self, op, **args):
+        """
+        Runs op on the remote helper and returns its result.
+        Returns None if there is no helper or the call failed so the caller can fall back to shell commands.
+        """
+        if self.agent is None:
+            return None
+        try:
+            return self.agent.call(op, **args)
+        except RemoteAgentError as e:
+            self.output("\tRemote helper failed ({}), using shell commands".format(e))
+            if not self.agent.alive:
+                self.agent = None
+            return None
+    def run_lsf(self, argv, stdin_file=None, coalesce=False):
+        """
+        Runs the LSF command argv (e.g. ["bjobs", "-w"]) with a login environment and returns a CommandResult.
+        Uses the remote helper if it is running and a login shell otherwise.
+        """
+        result = self.agent_call("lsf", argv=argv, stdin_file=stdin_file)
+        if result is not None:
+            return CommandResult(*result)
+        command = " ".join(shell_quote(arg) for arg in argv)
+        if stdin_file is not None:
+            command += " < " + shell_quote(stdin_file)
+        return self.executor.run("bash -lc " + shell_quote(command), coalesce=coalesce)
+    def submit(self, priority, func, *args, **kwargs):
+        """
+        Queues func(future, *args, **kwargs) on the scheduler and returns the future.
+        Errors raised by the task are written to the output.
+        """
+        future = self.scheduler.submit(priority, func, *args, **kwargs)
+        def report_error(future):
+            if not future.cancelled() and future.exception() is not None:
+                self.output("Error: {}".format(future.exception()))
+        future.add_done_callback(report_error)
+        return future
+    def cached(self, name, max_age, fetch_func, updated_func=None, wait=True):
+        """
+        Returns the value of name from the metadata cache, calling fetch_func() if it is not cached.
+        Values older than max_age seconds are returned right away and refreshed in the background,
+        updated_func(value) is then called if the value changed.
+        If wait is False a missing value is fetched in the background as well and None is returned
+        """
+        if self.cache is None:
+            return fetch_func()
+        value, fresh = self.cache.get(name, max_age)
+        if value is None and wait:
+            value = fetch_func()
+            if value:
+                self.cache.put(name, value)
+            return value
+        if not fresh and self.cache.start_refresh(name):
+            cache = self.cache
+            def refresh_task(task):
+                try:
+                    new_value = fetch_func()
+                finally:
+                    cache.end_refresh(name)
+                if new_value:
+                    cache.put(name, new_value)
+                else:
+                    cache.invalidate(name)
+                if new_value != value and updated_func:
+                    updated_func(new_value)
+            self.submit(PRIORITY_INTERACTIVE, refresh_task)
+        return value
+    def invalidate_cache(self, *names):
+        """Drops names from the metadata cache after the tool changed them on the cluster"""
+        if self.cache is not None:
+            self.cache.invalidate(*names)
+    def create_upload_task(self, dir_local, dir_remote, lsfinfo, update_func, glob_pattern="*.in", use_tar=True):
+        """
+        Queues upload of runs and submission of jobs. Returns the TaskFuture.
+        use_tar sends all files as one tar stream instead of one sftp transfer per file.
+        """
+        self.upload_task = self.submit(PRIORITY_TRANSFER, self.upload_and_submit,
+                                       dir_local, dir_remote, lsfinfo, update_func, glob_pattern, use_tar)
+        return self.upload_task
+    def create_download_task(self, run_folder, dir_remote, dir_local, update_func, **options):
+        """
+        Queues download of a run folder. Returns the TaskFuture.
+        options (use_tar, compress, sync, verify, file_filter) are passed on to download_run_folder.
+        """
+        future = self.submit(PRIORITY_TRANSFER, self.download_run_folder,
+                             run_folder, dir_remote, dir_local, update_func, **options)
+        self.download_tasks = [f for f in self.download_tasks if not f.done()] + [future]
+        return future
+    def start_status_poller(self, diff_func, interval=STATUS_POLL_INTERVAL):
+        """
+        Starts polling the job list every interval seconds with one batched call.
+        diff_func(added, changed, removed) receives the JobRecords that changed since the last poll
+        and is called from the poller thread. Returns the StatusPoller.
+        """
+        self.stop_status_poller()
+        def report_error(e):
+            self.output("Error: Job status poll failed ({})".format(e))
+        self.status_poller = StatusPoller(lambda: self.get_job_list(verbose=False), diff_func,
+                                          interval, report_error)
+        self.status_poller.start()
+        return self.status_poller
+    def stop_status_poller(self):
+        if self.status_poller:
+            self.status_poller.stop()
+            self.status_poller = None
+    def follow_job(self, jobid, data_func, interval=FOLLOW_POLL_INTERVAL):
+        """
+        Follows the files written to the run folders of a job, which are found with get_job_info.
+        data_func(path, text) receives text appended to a file and is called from the follower thread.
+        Only one job is followed at a time. Returns the OutputFollower or None if the job is not found.
+        """
+        self.stop_follower()
+        job = self.get_job_info(jobid)
+        if job is None or not job.run_folder:
+            self.output("Error: No run folder found for job {}".format(jobid))
+            return None
+        #packed jobs run several folders
+        roots = [self.run_path + "/" + folder for folder in job.run_folder.split(", ")]
+        self.output("\nFollowing output of job {} in {}".format(jobid, job.run_folder), False)
+        def report_error(e):
+            self.output("Error: Reading output of job {} failed ({})".format(jobid, e))
+        self.follower = OutputFollower(lambda offsets, tail_bytes: self.tail_files(roots, offsets, tail_bytes),
+                                       data_func, interval, report_error)
+        self.follower.start()
+        return self.follower
+    def create_follow_task(self, jobid, data_func, interval=FOLLOW_POLL_INTERVAL):
+        """Queues follow_job. The TaskFuture's result is the OutputFollower"""
+        def follow_task(task):
+            return self.follow_job(jobid, data_func, interval)
+        return self.submit(PRIORITY_INTERACTIVE, follow_task)
+    def stop_follower(self):
+        if self.follower:
+            self.follower.stop()
+            self.follower = None
+    def tail_files(self, roots, offsets, tail_bytes=None, max_bytes=FOLLOW_MAX_BYTES, exclude=FOLLOW_EXCLUDE):
+        """
+        Reads what was appended to the files below the remote folders roots with a single call.
+        offsets gives the byte offset each file path was read up to. Files not in offsets are read
+        from the start, or only their last tail_bytes if given. At most the last max_bytes of a file are read.
+        Files matching a pattern in exclude are skipped.
+        Returns a list of (path, start, end, text) for the files that grew
+        """
+        roots = [root.rstrip("/") for root in roots]
+        chunks = self.agent_call("tail", roots=roots, offsets=offsets, tail_bytes=tail_bytes,
+                                 max_bytes=max_bytes, exclude=list(exclude))
+        if chunks is not None:
+            return [tuple(chunk) for chunk in chunks]
+        script = TAIL_SOURCE % {"filter": find_filter_args(FileFilter(None, exclude, None))}
+        command = "bash -c {} tail {} {} {}".format(shell_quote(script), -1 if tail_bytes is None else tail_bytes,
+                                                    max_bytes, " ".join(shell_quote(root) for root in roots))
+        result = self.executor.run(command, "".join("{}\t{}\n".format(offset, path)
+                                                    for path, offset in offsets.items()))
+        chunks = []
+        for line in result.stdout.splitlines():
+            fields = line.rsplit("\t", 2)
+            if len(fields) != 3:
+                continue
+            data = base64.b64decode(fields[2])
+            start = int(fields[1])
+            chunks.append((fields[0], start, start + len(data), data.decode("utf-8", "replace")))
+        return chunks
+    def upload_and_submit(self, task, dir_local, dir_remote, lsfinfo, update_func, glob_pattern="*.in", use_tar=True):
+        """
+        Uploads runs and submits jobs unless the task was aborted.
+        Returns the list of submitted job ids
+        """
+        jobfiles = self.sftp_upload(task, dir_local, dir_remote, lsfinfo, update_func, glob_pattern, use_tar)
+        if not task.abort:
+            return self.pybsub(jobfiles)
+    def download_run_folder(self, task, run_folder, dir_remote, dir_local, update_func,
+                            use_tar=True, compress=False, sync=False, verify=False, file_filter=None):
+        """
+        Downloads a run folder from the cluster.
+        The folder is streamed as a tar archive by default and falls back to
+        per file sftp if tar is not usable on the cluster.
+        use_tar - stream files with tar instead of one sftp transfer per file
+        compress - gzip the tar stream on the cluster
+        sync - only fetch files that are new or changed locally and resume partial downloads
+        verify - in sync mode compare digests of files whose size matches but mtime does not
+        file_filter - FileFilter selecting the files to download, applied by the remote listing
+        """
+        task.run_folder = run_folder
+        #listing of everything in the folder, used for totals and the sftp fallback
+        entries = self.scan_remote_tree(dir_remote, file_filter)
+        local_root = os.path.join(str(dir_local), posixpath.basename(dir_remote.rstrip("/")))
+        folders = [entry for entry in entries if entry.type == "d"]
+        #result archives and their manifests are not downloaded as files
+        files = [entry for entry in entries if entry.type == "f" and not is_result_file(entry.path)]
+        some_files = len(files) < len([entry for entry in entries if entry.type == "f"])
+        #folders packed by their job into a current result archive. Archives hold all files so are
+        #not used for a filtered download
+        archives = self.result_archives(dir_remote, entries) if some_files and not file_filter else {}
+        #files with a partial download that can be continued
+        resume = []
+        if sync:
+            num_files = len(files)
+            files = self.changed_entries(dir_remote, local_root, files, verify)
+            self.output("\n{} of {} files in {} are new or changed".format(len(files), num_files, dir_remote))
+            resume = set(entry for entry in files
+                         if os.path.exists(partial_path(local_path_of(local_root, entry), entry.mtime)))
+            for entry in folders:
+                if not os.path.isdir(local_path_of(local_root, entry)):
+                    os.makedirs(local_path_of(local_root, entry))
+        if archives:
+            #an archive is fetched instead of its folder's files if all of them are wanted
+            wanted = set(files)
+            run_folders = input_folders(entries)
+            for entry in entries:
+                if entry.type == "f" and not is_result_file(entry.path) and entry not in wanted:
+                    archives.pop(archive_folder(entry.path, run_folders), None)
+            files = [entry for entry in files if archive_folder(entry.path, run_folders) not in archives]
+            self.output("\nFetching {} folders as result archives".format(len(archives)))
+        #byte progress of the download
+        task.progress = self.progress.start(run_folder, sum(entry.size for entry in files) +
+                                            sum(entry.size for entry in archives.values()),
+                                            lambda info: update_func(info.percent, run_folder))
+        try:
+            #a full download streams the whole folder, otherwise only the listed files are sent
+            paths = None
+            if sync or some_files or file_filter:
+                paths = [entry.path for entry in files if entry not in resume]
+            if use_tar and (paths is None or paths):
+                #files the tar stream wrote completely
+                completed = set()
+                if self.tar_get(task, dir_remote, dir_local, compress, paths, completed):
+                    files = [entry for entry in files if entry in resume]
+                else:
+                    #only the files the stream did not finish are fetched again, partial ones are continued.
+                    #A sync checks them against the local copies like its first pass
+                    if sync:
+                        files = self.changed_entries(dir_remote, local_root, files)
+                    else:
+                        files = [entry for entry in files if entry.path not in completed]
+                    task.progress.reset(sum(entry.size for entry in files) +
+                                        sum(entry.size for entry in archives.values()))
+            if not task.abort and (files or not use_tar):
+                self.sftp_get_files(task, dir_remote, dir_local, folders + files)
+            if not task.abort and archives:
+                self.get_result_archives(task, dir_remote, dir_local, archives)
+        finally:
+            task.progress.finish(not task.abort)
+    def extract_summary(self, task, dir_remote, rules):
+        """
+        Runs extraction rules over every file below dir_remote on the cluster in one pass
+        and returns the values found as a SummaryTable. Only the table is sent back.
+        rules is a list of dictionaries which contain
+            name - column name of the extracted value
+            files - glob pattern of the file names the rule reads (optional, default all files)
+            pattern - regular expression searched line by line. The first match is the value,
+                      or its first group if it has one (optional)
+            lines - [first, last] numbers of the lines the rule reads, last may be None for the end
+                    of the file (optional). Without a pattern the value is these lines joined by spaces
+        Needs python on the cluster.
+        """
+        for rule in rules:
+            if not (rule.get('pattern') or rule.get('lines')):
+                raise ValueError("Extraction rule {} needs a pattern or lines".format(rule.get('name')))
+            if rule.get('pattern'):
+                re.compile(rule['pattern'])
+        self.output("\nExtracting {} fields from {} ...".format(len(rules), dir_remote))
+        table = SummaryTable([rule['name'] for rule in rules])
+        rules_arg = to_text(base64.b64encode(to_bytes(json.dumps(
+            [dict((key, rule.get(key)) for key in ('files', 'pattern', 'lines')) for rule in rules]))))
+        source = to_text(base64.b64encode(to_bytes(EXTRACT_SOURCE)))
+        command = "PY=$(command -v python3 || command -v python) && exec \"$PY\" -c {} {} {}".format(
+            shell_quote("import base64; exec(base64.b64decode('{}'))".format(source)),
+            shell_quote(rules_arg), shell_quote(dir_remote))
+        unescape = lambda text: re.sub(r"\\(.)", lambda m: {"t": "\t", "n": "\n"}.get(m.group(1), m.group(1)), text)
+        with self.executor.open("bash -lc " + shell_quote(command), stream=True) as chan:
+            stdout = chan.makefile("rb", -1)
+            for line in stdout:
+                if task.abort:
+                    return table
+                fields = to_text(line).rstrip("\n").split("\t")
+                if len(fields) == len(table.columns):
+                    table.add_row([unescape(field) for field in fields])
+            if chan.recv_exit_status() != 0:
+                self.output("Error: {}".format(to_text(chan.makefile_stderr("r", -1).read()).strip()))
+        self.output("\tFound values in {} files".format(len(table)))
+        return table
+    def create_summary_task(self, dir_remote, rules):
+        """
+        Queues extract_summary of dir_remote. The TaskFuture's result is the SummaryTable.
+        Runs with the transfers since it reads the whole run tree
+        """
+        return self.submit(PRIORITY_TRANSFER, self.extract_summary, dir_remote, rules)
+    def result_archives(self, dir_remote, entries):
+        """
+        Finds the folders below dir_remote that their job packed into a result archive which is still current.
+        An archive holds the files of its folder as given by archive_folder. It is current if its manifest lists
+        exactly those files with the same sizes and none of them changed after the archive was written.
+        The manifests are read with one call.
+        Returns a dictionary mapping folder (relative to dir_remote) to the RemoteEntry of its archive
+        """
+        archives = dict((posixpath.dirname(entry.path), entry) for entry in entries
+                        if entry.type == "f" and posixpath.basename(entry.path) == RESULT_ARCHIVE)
+        if not archives:
+            return {}
+        run_folders = input_folders(entries)
+        #folder -> {path: size} of the files in archived folders as they are now
+        listed = dict((folder, {}) for folder in archives)
+        for entry in entries:
+            folder = archive_folder(entry.path, run_folders)
+            if entry.type != "f" or folder not in archives or is_result_file(entry.path):
+                continue
+            if entry.mtime > archives[folder].mtime:
+                listed[folder] = None
+            elif listed[folder] is not None:
+                listed[folder][posixpath.relpath(entry.path, folder) if folder else entry.path] = entry.size
+        result = self.executor.run("find {} -name {} -exec awk 'FNR==1{{print \"#MANIFEST \" FILENAME}} {{print}}' {{}} +".format(
+            clean_path(dir_remote), RESULT_MANIFEST), coalesce=True)
+        #folder -> {path: size} as listed in its manifest
+        manifests = {}
+        manifest = None
+        for line in result.stdout.splitlines():
+            if line.startswith("#MANIFEST "):
+                folder = posixpath.relpath(posixpath.dirname(line[len("#MANIFEST "):]), dir_remote)
+                manifest = manifests.setdefault("" if folder == "." else folder, {})
+            elif manifest is not None:
+                size, sep, name = line.partition(" ")
+                if size.isdigit():
+                    manifest[name] = int(size)
+        return dict((folder, entry) for folder, entry in archives.items()
+                    if listed[folder] is not None and manifests.get(folder) == listed[folder])
+    def get_result_archives(self, task, dir_remote, dir_local, archives):
+        """
+        Fetches result archives found by result_archives and unpacks each into its local folder as it arrives.
+        Bytes of the archives are counted on task.progress.
+        """
+        local_root = os.path.join(str(dir_local), posixpath.basename(dir_remote.rstrip("/")))
+        def get_archive(sftp, folder, entry):
+            self.output("\tUnpacking {}".format(dir_remote + "/" + entry.path))
+            local_folder = os.path.join(local_root, *folder.split("/")) if folder else local_root
+            with sftp.open(dir_remote + "/" + entry.path, "rb") as f:
+                f.prefetch(entry.size)
+                with tarfile.open(fileobj=CountingReader(f, task.progress.add), mode="r|gz") as tar:
+                    for member in tar:
+                        if task.abort:
+                            return
+                        if not (is_safe_member(member) and member.isfile()):
+                            self.output("\tSkipping {}".format(member.name))
+                            continue
+                        write_file(tar.extractfile(member), os.path.join(local_folder, *member.name.split("/")),
+                                   member.mtime, lambda num_bytes: None)
+        ParallelTransfer(self.pool, task, self.transfer_concurrency).run(
+            [lambda sftp, folder=folder, entry=entry: get_archive(sftp, folder, entry)
+             for folder, entry in sorted(archives.items())])
+    def changed_entries(self, dir_remote, local_root, entries, verify=False):
+        """
+        Compares remote file entries against the local copy under local_root.
+        Files are unchanged if size and mtime match. With verify, files whose size matches
+        but mtime differs are compared by digest, computed on the cluster in one call.
+        Returns the entries of files that are missing or changed locally
+        """
+        changed = []
+        #files that need a digest comparison
+        check = []
+        for entry in entries:
+            local_path = local_path_of(local_root, entry)
+            try:
+                st = os.stat(local_path)
+            except OSError:
+                changed.append(entry)
+                continue
+            if st.st_size == entry.size and abs(st.st_mtime - entry.mtime) < MTIME_TOLERANCE:
+                continue
+            if verify and st.st_size == entry.size:
+                check.append((entry, local_path))
+            else:
+                changed.append(entry)
+        if check:
+            remote_digests = self.remote_digests(dir_remote, paths=[entry.path for entry, local_path in check])
+            for entry, local_path in check:
+                if remote_digests.get(dir_remote + "/" + entry.path) == file_digest(local_path):
+                    #same contents, just take over the remote mtime
+                    os.utime(local_path, (entry.mtime, entry.mtime))
+                else:
+                    changed.append(entry)
+        return changed
+    def iter_remote_tree(self, dir_remote, file_filter=None):
+        """
+        Lists everything below dir_remote with a single find call and yields a RemoteEntry
+        for each item as the listing streams in. Paths are relative to dir_remote.
+        Files not selected by file_filter (a FileFilter) are dropped by find on the cluster.
+        Falls back to walking the folder with sftp listdir_attr if find -printf is not available.
+        With the remote helper running the listing comes from its scan instead.
+        """
+        if file_filter:
+            entries = self.agent_call("scan", root=dir_remote, include=file_filter.include,
+                                      exclude=file_filter.exclude, max_size=file_filter.max_size)
+        else:
+            entries = self.agent_call("scan", root=dir_remote)
+        if entries is not None:
+            for entry_type, size, mtime, path in entries:
+                yield RemoteEntry(path, entry_type, size, mtime)
+            return
+        found = 0
+        with self.executor.open("find {} -mindepth 1 {}-printf '%y\\t%s\\t%T@\\t%P\\0'".format(
+                clean_path(dir_remote), find_filter_args(file_filter)), stream=True) as chan:
+            stdout = chan.makefile("rb", -1)
+            #incomplete record at the end of the last chunk
+            pending = b""
+            for chunk in iter(lambda: stdout.read(SCAN_CHUNK_SIZE), b""):
+                records = (pending + chunk).split(b"\0")
+                pending = records.pop()
+                for record in records:
+                    fields = to_text(record).split("\t", 3)
+                    if len(fields) == 4:
+                        found += 1
+                        yield RemoteEntry(fields[3], fields[0], int(fields[1]), float(fields[2]))
+            exit_status = chan.recv_exit_status()
+        if exit_status != 0 and not found:
+            for entry in self.sftp_walk(dir_remote):
+                if entry.type != "f" or filter_matches(file_filter, entry):
+                    yield entry
+    def scan_remote_tree(self, dir_remote, file_filter=None):
+        """Returns the listing of dir_remote as a list of RemoteEntries, see iter_remote_tree"""
+        return list(self.iter_remote_tree(dir_remote, file_filter))
+    def sftp_walk(self, dir_remote):
+        """Yields a RemoteEntry for everything below dir_remote using one listdir_attr per folder"""
+        with self.pool.sftp() as sftp:
+            folders = [""]
+            while folders:
+                folder = folders.pop()
+                for attr in sftp.listdir_attr(posixpath.join(dir_remote, folder)):
+                    path = posixpath.join(folder, attr.filename)
+                    if S_ISDIR(attr.st_mode):
+                        entry_type = "d"
+                        folders.append(path)
+                    elif S_ISLNK(attr.st_mode):
+                        entry_type = "l"
+                    else:
+                        entry_type = "f"
+                    yield RemoteEntry(path, entry_type, attr.st_size, attr.st_mtime)
+    def tar_get(self, task, dir_remote, dir_local, compress=False, paths=None, completed=None):
+        """
+        Downloads folder by running tar on the cluster and extracting the stream as it arrives.
+        No archive is written on either side. If paths is given only those files
+        (relative to dir_remote) are sent. Bytes written are counted on task.progress.
+        The path (relative to dir_remote) of every file written is added to the set completed if given.
+        Returns False if the tar stream could not be used so the caller can fall back to sftp
+        for the files that are not completed.
+        """
+        parent, name = posixpath.split(dir_remote.rstrip("/"))
+        command = "tar -C {} -c{}f - {}".format(clean_path(parent or "."), "z" if compress else "",
+                                               "--null -T -" if paths is not None else clean_path(name))
+        with self.executor.open(command, stream=True) as chan:
+            if paths is not None:
+                #send the file list from another thread so a long list can't block the stream
+                def send_paths():
+                    for path in paths:
+                        chan.sendall(to_bytes(name + "/" + path + "\0"))
+                    chan.shutdown_write()
+                sender = threading.Thread(target=send_paths)
+                sender.daemon = True
+                sender.start()
+            self.output("\nStreaming folder {} to folder {}...".format(dir_remote, dir_local))
+            try:
+                with tarfile.open(fileobj=chan.makefile("rb", -1), mode="r|gz" if compress else "r|") as tar:
+                    for member in tar:
+                        if task.abort:
+                            return True
+                        if not is_safe_member(member):
+                            self.output("\tSkipping {}".format(member.name))
+                            continue
+                        local_path = os.path.join(str(dir_local), *member.name.split("/"))
+                        if member.isdir():
+                            if not os.path.isdir(local_path):
+                                os.makedirs(local_path)
+                        else:
+                            write_file(tar.extractfile(member), local_path, member.mtime, task.progress.add)
+                            if completed is not None:
+                                completed.add(posixpath.relpath(member.name, name))
+            except tarfile.TarError as e:
+                self.output("\tTar stream failed ({}), falling back to sftp".format(e))
+                return False
+            exit_status = chan.recv_exit_status()
+            if exit_status == 1:
+                #files changed while tar read them, e.g. outputs of running jobs. They were sent
+                #as they were when tar got to them, like any file that changes after a download
+                self.output("\tTar reported changed files: {}".format(
+                    to_text(chan.makefile_stderr("r", -1).read()).strip()))
+            elif exit_status != 0:
+                self.output("\tTar reported errors: {}".format(to_text(chan.makefile_stderr("r", -1).read()).strip()))
+                self.output("\tFalling back to sftp")
+                return False
+            self.output("\tDownload Complete")
+            return True
+    def sftp_get_files(self, task, dir_remote, dir_local, entries, concurrency=None):
+        """
+        Downloads the folders and files listed in entries over sftp.
+        entries is a listing from scan_remote_tree. Links are skipped.
+        concurrency files are fetched at the same time (default transfer_concurrency) and
+        files above RANGE_SPLIT_SIZE are fetched as ranges in parallel.
+        Partial downloads of an unchanged remote file are continued from where they stopped.
+        Bytes written are counted on task.progress.
+        """
+        concurrency = concurrency or self.transfer_concurrency
+        dir_local = os.path.join(str(dir_local), posixpath.basename(dir_remote.rstrip("/")))
+        self.output("\nDownloading from folder {} to folder {}...".format(dir_remote, dir_local))
+        if not os.path.isdir(dir_local):
+            os.makedirs(dir_local)
+        #range downloads left by an earlier failed or aborted download can't be continued
+        for dirpath, filenames in walk_files(dir_local):
+            for fname in filenames:
+                if fname.endswith(RANGES_SUFFIX):
+                    os.remove(os.path.join(dirpath, fname))
+        jobs = []
+        #partial files of the range downloads, removed unless they were completed
+        range_parts = []
+        for entry in entries:
+            local_path = local_path_of(dir_local, entry)
+            if entry.type == "d":
+                if not os.path.isdir(local_path):
+                    os.makedirs(local_path)
+            elif entry.type == "f":
+                remote_file = dir_remote + "/" + entry.path
+                part = partial_path(local_path, entry.mtime)
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                if offset > entry.size:
+                    offset = 0
+                if concurrency > 1 and not offset and entry.size > RANGE_SPLIT_SIZE:
+                    jobs.extend(self.range_get_jobs(task, remote_file, local_path, entry))
+                    range_parts.append(ranges_path(local_path, entry.mtime))
+                    continue
+                def get_file(sftp, remote_file=remote_file, local_path=local_path, entry=entry, offset=offset):
+                    with sftp.open(remote_file, "rb") as f:
+                        f.seek(offset)
+                        f.prefetch(entry.size)
+                        task.progress.add(offset)
+                        write_file(f, local_path, entry.mtime, task.progress.add, offset)
+                jobs.append(get_file)
+        try:
+            ParallelTransfer(self.pool, task, concurrency).run(jobs)
+        finally:
+            for part in range_parts:
+                if os.path.exists(part):
+                    os.remove(part)
+        if not task.abort:
+            self.output("\tDownload Complete")
+    def range_get_jobs(self, task, remote_file, local_path, entry):
+        """
+        Returns transfer jobs that each fetch one range of a large remote file into its partial file.
+        The first job to run creates the partial file and the job finishing last moves the file in place.
+        The caller removes the partial file if the download does not complete
+        """
+        if not os.path.isdir(os.path.dirname(local_path)):
+            os.makedirs(os.path.dirname(local_path))
+        part = ranges_path(local_path, entry.mtime)
+        ranges = split_ranges(entry.size, RANGE_SPLIT_SIZE)
+        lock = threading.Lock()
+        remaining = [len(ranges)]
+        created = [False]
+        def get_range(sftp, start, length):
+            with lock:
+                if not created[0]:
+                    with open(part, "wb") as local_file:
+                        local_file.truncate(entry.size)
+                    created[0] = True
+            with sftp.open(remote_file, "rb") as f:
+                with open(part, "r+b") as local_file:
+                    f.seek(start)
+                    f.prefetch(start + length)
+                    local_file.seek(start)
+                    copy_range(f, local_file, length, task.progress.add)
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                finish_partial(part, local_path, entry.mtime)
+        return [lambda sftp, start=start, length=length: get_range(sftp, start, length)
+                for start, length in ranges]
+    def benchmark_download(self, task, dir_remote, concurrencies=(1, 2, 4, 8)):
+        """
+        Times full sftp downloads of dir_remote into a temporary folder at each concurrency
+        to find a good transfer_concurrency. A concurrency of 1 is the serial one file at a time transfer.
+        Returns a list of tuples (concurrency, seconds, bytes per second)
+        """
+        entries = self.scan_remote_tree(dir_remote)
+        total_bytes = sum(entry.size for entry in entries if entry.type == "f")
+        results = []
+        for concurrency in concurrencies:
+            if task.abort:
+                break
+            dir_local = tempfile.mkdtemp()
+            task.progress = self.progress.start("benchmark x{}".format(concurrency), total_bytes)
+            start_time = time.time()
+            try:
+                self.sftp_get_files(task, dir_remote, dir_local, entries, concurrency)
+            finally:
+                task.progress.finish(not task.abort)
+                shutil.rmtree(dir_local, ignore_errors=True)
+            seconds = time.time() - start_time
+            results.append((concurrency, seconds, total_bytes/max(seconds, 1e-6)))
+            self.output("\t{} at a time: {:.1f}s, {}/s".format(concurrency, seconds,
+                                                               format_bytes(results[-1][2])))
+        return results
+    def create_benchmark_task(self, dir_remote, concurrencies=(1, 2, 4, 8)):
+        """Queues benchmark_download of dir_remote. Returns the TaskFuture"""
+        return self.submit(PRIORITY_TRANSFER, self.benchmark_download, dir_remote, concurrencies)
+    def sftp_upload(self, task, dir_local, dir_remote, lsfinfo, progress_func, glob_pattern = "*.in", use_tar=True):
+        """
+        Uploads local directory to remote server and generates the job files and returns the list of job files.
+        There is a job file per subfolder or a job array for all subfolders if lsfinfo['job_array'] is set.
+        The folder is scanned by an UploadPipeline so files are sent while the scan is still running.
+        By default the files and job files are sent as a single tar stream with per file sftp as fallback.
+        """
+        self.output("\nSubmitting runs from folder {} ...".format(dir_local))
+        #cached digests of the local files and record of what was uploaded where
+        manifest = InputManifest(dir_local)
+        remote_base = dir_remote + '/' + os.path.basename(dir_local)
+        remote_key = self.remote_key(remote_base)
+        def file_sent(local_file, digest):
+            manifest.record(local_file, digest)
+            manifest.mark_uploaded(remote_key, local_file, digest)
+
+        #byte progress of the upload. Files are counted as the pipeline finds them
+        transfer = self.progress.start(os.path.basename(dir_local), 0, lambda info: progress_func(info.percent))
+        try:
+            sent = False
+            if use_tar:
+                pipeline = UploadPipeline(self, task, dir_local, remote_base, glob_pattern, manifest, transfer)
+                pipeline.start()
+                try:
+                    sent = self.tar_put(task, dir_remote, pipeline.remote_files(lsfinfo), pipeline.files(),
+                                        transfer, file_sent)
+                finally:
+                    pipeline.stop()
+            if not sent and not task.abort:
+                #a failed tar stream is scanned again for sftp. Digests are in the manifest by now
+                transfer.reset(0)
+                pipeline = UploadPipeline(self, task, dir_local, remote_base, glob_pattern, manifest, transfer)
+                pipeline.start()
+                try:
+                    self.sftp_put_files(task, pipeline.remote_files(lsfinfo), pipeline.files(), transfer, file_sent)
+                finally:
+                    pipeline.stop()
+        finally:
+            transfer.finish(not task.abort)
+            manifest.save()
+            #the run folder may have been created
+            self.invalidate_cache("run_folders:" + dir_remote)
+        if task.abort:
+            return None
+        self.output('\tFinished Upload')
+
+        return pipeline.jobfiles
+    def remote_digests(self, remote_root, name_pattern="*", paths=None):
+        """
+        Computes sha256 digests of all files matching name_pattern under remote_root on the cluster
+        with a single find | xargs sha256sum call. No file contents are transferred.
+        If paths (relative to remote_root) is given only those files are hashed, with xargs reading them from stdin.
+        Returns a dictionary mapping remote path to hex digest
+        """
+        digests = self.agent_call("hash", root=remote_root, pattern=name_pattern, paths=paths)
+        if digests is not None:
+            return digests
+        if paths is None:
+            result = self.executor.run(
+                "find {} -type f -name '{}' -print0 | xargs -0 -r sha256sum".format(clean_path(remote_root), name_pattern),
+                coalesce=True)
+        else:
+            result = self.executor.run("xargs -0 -r sha256sum --",
+                                       "".join(remote_root.rstrip("/") + "/" + path + "\0" for path in paths))
+        digests = {}
+        for line in result.stdout.splitlines():
+            line = to_text(line).rstrip("\r\n")
+            digest, sep, path = line.partition(" ")
+            if not sep:
+                continue
+            #sha256sum escapes file names containing backslash or newline and marks the line with a backslash
+            if digest.startswith("\\"):
+                digest = digest[1:]
+                path = re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), path)
+            #path is preceded by a space in text mode or * in binary mode
+            digests[path[1:]] = digest
+        return digests
+    def remote_key(self, remote_path):
+        """Identifies a remote folder on the current cluster in the upload manifests"""
+        return "{}@{}:{}".format(self.username, self.hostname, remote_path)
+    def tar_put(self, task, dir_remote, remote_files, files_to_upload, transfer, sent_func=None):
+        """
+        Sends the files to upload (tuples (local file, remote file)) followed by the generated remote_files
+        (tuples (remote file, text)) as one tar stream which is unpacked under dir_remote by tar on the cluster.
+        Both may be generators, files are sent as they come.
+        This creates all folders and files over a single channel.
+        sent_func(local_file, digest) is called for every file once the cluster confirmed the upload.
+        Bytes sent are counted on transfer.
+        Returns False if the stream failed so the caller can fall back to sftp.
+        """
+        #digests of files in the stream, passed to sent_func once tar succeeded
+        sent_files = []
+        #the first file is taken before the channel is opened. Producing it may need remote commands
+        #(the pipeline's remote digests) which must not wait for a slot held by this stream
+        files_to_upload = iter(files_to_upload)
+        first_files = list(itertools.islice(files_to_upload, 1))
+        if task.abort:
+            return True
+        with self.executor.open("mkdir -p {0} && tar -C {0} -xf -".format(clean_path(dir_remote)), stream=True) as chan:
+            stream = chan.makefile("wb", -1)
+            self.output("\tStreaming files to {}".format(dir_remote))
+            try:
+                tar = tarfile.open(fileobj=stream, mode="w|")
+                for local_file, remote_file in itertools.chain(first_files, files_to_upload):
+                    if task.abort:
+                        return True
+                    self.output('\tCopying {} to {}'.format(local_file, remote_file))
+                    info = tar.gettarinfo(local_file, posixpath.relpath(remote_file, dir_remote))
+                    with open(local_file, "rb") as f:
+                        reader = CountingReader(f, transfer.add)
+                        tar.addfile(info, reader)
+                    sent_files.append((local_file, reader.hexdigest()))
+                if task.abort:
+                    return True
+                # Job files are added straight from memory
+                for remote_file, text in remote_files:
+                    self.output('\tWriting Job file: {}'.format(remote_file))
+                    data = to_bytes(text)
+                    info = tarfile.TarInfo(posixpath.relpath(remote_file, dir_remote))
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    info.mode = 0o644
+                    tar.addfile(info, io.BytesIO(data))
+                tar.close()
+                stream.flush()
+                chan.shutdown_write()
+            except (socket.error, EOFError, paramiko.SSHException) as e:
+                self.output("\tTar stream failed ({}), falling back to sftp".format(e))
+                return False
+            if chan.recv_exit_status() != 0:
+                self.output("\tTar reported errors: {}".format(to_text(chan.makefile_stderr("r", -1).read()).strip()))
+                self.output("\tFalling back to sftp")
+                return False
+            if sent_func:
+                for local_file, digest in sent_files:
+                    sent_func(local_file, digest)
+            return True
+    def sftp_put_files(self, task, remote_files, files_to_upload, transfer, sent_func=None, concurrency=None):
+        """
+        Uploads the files (tuples (local file, remote file)) over sftp and then writes the generated
+        remote_files (tuples (remote file, text)). Both may be generators, files are sent as they come.
+        Remote folders are created over sftp when the first file for them arrives.
+        Bytes sent are counted on transfer.
+        concurrency files are sent at the same time (default transfer_concurrency) and
+        files above RANGE_SPLIT_SIZE are sent as ranges in parallel.
+        sent_func(local_file, digest) is called after each file is uploaded.
+        """
+        concurrency = concurrency or self.transfer_concurrency
+        #remote folders known to exist
+        created_dirs = set()
+        def make_dirs(sftp, remote_dir):
+            if remote_dir not in created_dirs:
+                self.output("\tCreating {}".format(remote_dir))
+                sftp_makedirs(sftp, remote_dir, created_dirs)
+        def put_file(sftp, local_file, remote_file):
+            self.output('\tCopying {} to {}'.format(local_file, remote_file))
+            with open(local_file, "rb") as f:
+                reader = CountingReader(f, lambda num_bytes: None)
+                sftp.putfo(reader, remote_file, callback=transfer.sftp_callback())
+            if sent_func:
+                sent_func(local_file, reader.hexdigest())
+        #jobs are generated one at a time by the transfer threads, folders are made before their files are handed out
+        def jobs(sftp):
+            for local_file, remote_file in files_to_upload:
+                make_dirs(sftp, posixpath.dirname(remote_file))
+                size = os.path.getsize(local_file)
+                if concurrency > 1 and size > RANGE_SPLIT_SIZE:
+                    for job in self.range_put_jobs(local_file, remote_file, size, transfer, sent_func):
+                        yield job
+                else:
+                    yield lambda sftp, local_file=local_file, remote_file=remote_file: put_file(sftp, local_file, remote_file)
+            for remote_file, text in remote_files:
+                make_dirs(sftp, posixpath.dirname(remote_file))
+                yield lambda sftp, remote_file=remote_file, text=text: self.write_jobfile(remote_file, text, sftp)
+        with self.pool.sftp() as sftp:
+            ParallelTransfer(self.pool, task, concurrency).run(jobs(sftp))
+    def range_put_jobs(self, local_file, remote_file, size, transfer, sent_func=None):
+        """
+        Returns transfer jobs that each write one range of a large local file with pipelined writes.
+        The first job creates the remote file and the job finishing last calls sent_func
+        """
+        ranges = split_ranges(size, RANGE_SPLIT_SIZE)
+        lock = threading.Lock()
+        #remote file is created by the first job before any range is written
+        created = threading.Event()
+        remaining = [len(ranges)]
+        def put_range(sftp, start, length):
+            if start == 0:
+                self.output('\tCopying {} to {} in {} parts'.format(local_file, remote_file, len(ranges)))
+                try:
+                    sftp.open(remote_file, "wb").close()
+                finally:
+                    created.set()
+            else:
+                created.wait()
+            with open(local_file, "rb") as f:
+                with sftp.open(remote_file, "r+b") as remote:
+                    remote.set_pipelined(True)
+                    f.seek(start)
+                    remote.seek(start)
+                    copy_range(f, remote, length, transfer.add)
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last and sent_func:
+                sent_func(local_file, file_digest(local_file))
+        return [lambda sftp, start=start, length=length: put_range(sftp, start, length)
+                for start, length in ranges]
+    def write_jobfile(self, remote_file, text, sftp):
+        """Writes a generated job file to the cluster"""
+        self.output('\tWriting Job file: {}'.format(remote_file))
+        with sftp.open(remote_file, 'wb') as f:
+            f.write(to_bytes(text))
+    def build_jobfiles(self, remote_base, job_dirs, lsfinfo, job_work=None):
+        """
+        Generates the job files for the run folders in job_dirs.
+        Returns a list of tuples (remote file, text) that have to be written to the cluster
+        and the list of job files that have to be submitted.
+        With lsfinfo['pack_jobs'] the folders are packed into that many jobs balanced by the
+        estimated work in job_work and each job runs the folders listed in its map file.
+        With lsfinfo['job_array'] the folders are submitted as LSF job arrays with a
+        map file giving the run folder of each array index.
+        Map files are named per submission so jobs of an earlier submission that are
+        still pending keep reading their own map.
+        """
+        remote_files = []
+        jobfiles = []
+        submission = submission_tag()
+        if lsfinfo.get('pack_jobs'):
+            packs = pack_folders(job_dirs, job_work or {}, lsfinfo['pack_jobs'])
+            for pack_num, pack_dirs in enumerate(packs, 1):
+                map_file = "{}/job_pack_{}_{}.map".format(remote_base, submission, pack_num)
+                jobfile = "{}/job_pack_{}_{}.info".format(remote_base, submission, pack_num)
+                folders = [posixpath.relpath(curr_dir_remote, self.run_path) for curr_dir_remote in pack_dirs]
+                self.job_maps[map_file] = folders
+                remote_files.append((map_file, "".join(folder + "\n" for folder in folders)))
+                remote_files.append((jobfile, self.pack_jobfile_text(map_file, lsfinfo)))
+                jobfiles.append(jobfile)
+            return remote_files, jobfiles
+        if not lsfinfo.get('job_array'):
+            for curr_dir_remote in job_dirs:
+                remote_files.append((curr_dir_remote + '/job.info', self.jobfile_text(curr_dir_remote, lsfinfo)))
+                jobfiles.append(curr_dir_remote + '/job.info')
+            return remote_files, jobfiles
+
+        for array_num, start in enumerate(range(0, len(job_dirs), MAX_ARRAY_SIZE), 1):
+            array_dirs = job_dirs[start:start+MAX_ARRAY_SIZE]
+            map_file = "{}/job_array_{}_{}.map".format(remote_base, submission, array_num)
+            jobfile = "{}/job_array_{}_{}.info".format(remote_base, submission, array_num)
+            #line i of the map is the run folder of array index i
+            folders = [posixpath.relpath(curr_dir_remote, self.run_path) for curr_dir_remote in array_dirs]
+            self.job_maps[map_file] = folders
+            remote_files.append((map_file, "".join(folder + "\n" for folder in folders)))
+            remote_files.append((jobfile, self.array_jobfile_text(map_file, len(array_dirs), lsfinfo)))
+            jobfiles.append(jobfile)
+        return remote_files, jobfiles
+    def jobfile_header(self, lsfinfo, jobname):
+        """Returns the #BSUB lines of a job file"""
+        header = "#!/bin/bash\n" +\
+                 "#BSUB -J \"" + jobname + "\"\n" +\
+        "#BSUB -q " + lsfinfo['queue']   + "\n"
+        if 'email' in lsfinfo:
+            header += "#BSUB -u " + lsfinfo['email']   + "\n" + \
+            "#BSUB -N\n"
+        return header
+    def pack_results_text(self, lsfinfo):
+        """
+        Returns the shell function that packs the files of a finished run folder, including those in
+        subfolders that are not run folders themselves, into one archive with a manifest if
+        lsfinfo['compress_results'] is set. Goes after all #BSUB lines
+        """
+        if not lsfinfo.get('compress_results'):
+            return ""
+        #archive and manifest are written under temporary names so a half written archive is never used
+        return "pack_results() {\n" + \
+               "    ( cd \"$1\" &&\n" + \
+               "      find . -mindepth 1 -type d -exec sh -c 'set -- \"$0\"/{2}; [ -e \"$1\" ]' {{}} \\; -prune -o \\\n" \
+               "        -type f ! -name '{0}*' ! -name '{1}*' -printf '%s %P\\n' > {1}.part &&\n".format(
+                   RESULT_ARCHIVE, RESULT_MANIFEST, RUN_INPUT) + \
+               "      sed 's/^[0-9]* //' {0}.part | tar -czf {1}.part --no-recursion -T - &&\n".format(RESULT_MANIFEST, RESULT_ARCHIVE) + \
+               "      mv {0}.part {0} && mv {1}.part {1} )\n".format(RESULT_ARCHIVE, RESULT_MANIFEST) + \
+               "}\n"
+    def run_command(self, lsfinfo, run_dir):
+        """Returns the command that runs the model on run_dir followed by packing its results if asked for"""
+        command = self.model_command(lsfinfo, run_dir)
+        if lsfinfo.get('compress_results'):
+            command += "; pack_results " + run_dir
+        return command
+    def model_command(self, lsfinfo, run_dir):
+        """Returns the command that runs the model on run_dir, which is a path as written in the shell"""
+        if lsfinfo['modeltype'] != "smoking":
+            return self.model_path + "/" + lsfinfo['modeltype'] + "/" + lsfinfo['modelversion'] + " " + run_dir
+        else:
+            return "/data/cepac/python/bin/python3.6 " + self.model_path + "/" + lsfinfo['modeltype'] + "/"+ \
+                            lsfinfo['modelversion'] + "/sim.py" + " " + run_dir
+    def jobfile_text(self, curr_dir_remote, lsfinfo):
+        """
+        Returns the contents of the job file for the current folder.
+        lsfinfo is a dictionary which contains
+            jobname - name of the job
+            queue - the queue to submit to
+            email - email address to send upon job completion (optional)
+            modeltype - should be either treatm, debug, or transm
+            modelversion - name of the model version to run
+            job_array - submit all folders as a job array instead of one job each (optional)
+            pack_jobs - number of jobs to pack all folders into (optional)
+            pack_parallel - number of folders each packed job runs at the same time (optional, default 1)
+            compress_results - pack each run folder into RESULT_ARCHIVE once it ran (optional)
+        """
+        return self.jobfile_header(lsfinfo, lsfinfo['jobname']) + \
+               self.pack_results_text(lsfinfo) + \
+               self.run_command(lsfinfo, "~/" + clean_path(curr_dir_remote))
+    def array_jobfile_text(self, map_file, num_jobs, lsfinfo):
+        """
+        Returns the contents of a job array file running num_jobs folders.
+        Each array element looks up its run folder in map_file.
+        """
+        return self.jobfile_header(lsfinfo, "{}[1-{}]".format(lsfinfo['jobname'], num_jobs)) + \
+               self.pack_results_text(lsfinfo) + \
+               "JOB_MAP=~/" + clean_path(map_file) + "\n" + \
+               "RUN_FOLDER=$(sed -n \"${LSB_JOBINDEX}p\" \"$JOB_MAP\")\n" + \
+               self.run_command(lsfinfo, "~/" + clean_path(self.run_path) + "/\"$RUN_FOLDER\"")
+    def pack_jobfile_text(self, map_file, lsfinfo):
+        """
+        Returns the contents of a job file running all folders listed in map_file.
+        The folders are run one after the other or lsfinfo['pack_parallel'] at a time.
+        """
+        parallel = max(1, int(lsfinfo.get('pack_parallel', 1)))
+        text = self.jobfile_header(lsfinfo, lsfinfo['jobname'])
+        if parallel > 1:
+            text += "#BSUB -n {}\n".format(parallel) + \
+                    "#BSUB -R \"span[hosts=1]\"\n"
+        text += self.pack_results_text(lsfinfo)
+        text += "JOB_MAP=~/" + clean_path(map_file) + "\n" + \
+                "while IFS= read -r RUN_FOLDER <&3; do\n"
+        run_folder = self.run_command(lsfinfo, "~/" + clean_path(self.run_path) + "/\"$RUN_FOLDER\"")
+        if parallel > 1:
+            #keep at most parallel folders running. bash before 4.3 has no wait -n and polls instead
+            text += "    while [ $(jobs -rp | wc -l) -ge {} ]; do wait -n 2>/dev/null || sleep 1; done\n".format(parallel) + \
+                    "    { " + run_folder + "; } &\n"
+        else:
+            text += "    " + run_folder + "\n"
+        text += "done 3< \"$JOB_MAP\"\n" + \
+                "wait\n"
+        return text
+    def pybsub(self, jobfiles):
+        """
+        Submit jobs for job list to LSF.
+        All job files are submitted from one remote shell session.
+        Returns the list of assigned job ids
+        """
+        if self.agent is not None:
+            job_ids = self.agent_bsub(jobfiles)
+            if job_ids is not None:
+                return job_ids
+        result = self.executor.run(
+            "bash -lc 'while IFS= read -r job; do echo \"#JOBFILE $job\"; bsub < \"$job\"; done'",
+            data="".join(job + "\n" for job in jobfiles))
+
+        job_ids = []
+        job = None
+        for line in result.stdout.splitlines():
+            if line.startswith("#JOBFILE "):
+                job = line[len("#JOBFILE "):]
+                continue
+            match = re.search(r"Job <(\d+)> is submitted", line)
+            if match:
+                job_ids.append(match.group(1))
+                self.output('\tSubmitted :{} as job {}'.format(job, match.group(1)))
+        if result.stderr.strip():
+            self.output('Error: {}'.format(result.stderr))
+        return job_ids
+    def agent_bsub(self, jobfiles):
+        """
+        Submits the job files through the remote helper with all requests pipelined.
+        Returns the list of assigned job ids or None if the helper failed before anything was submitted
+        """
+        try:
+            futures = [self.agent.request("lsf", argv=["bsub"], stdin_file=job) for job in jobfiles]
+        except RemoteAgentError:
+            futures = []
+        job_ids = []
+        for job, future in zip(jobfiles, futures):
+            try:
+                exit_status, stdout, stderr = future.result()
+            except RemoteAgentError as e:
+                stdout, stderr = "", str(e)
+            match = re.search(r"Job <(\d+)> is submitted", stdout)
+            if match:
+                job_ids.append(match.group(1))
+                self.output('\tSubmitted :{} as job {}'.format(job, match.group(1)))
+            if stderr.strip():
+                self.output('Error: {}'.format(stderr))
+        if len(futures) < len(jobfiles) and not job_ids:
+            self.agent = None
+            return None
+        return job_ids
+    def get_run_folders(self, max_age=RUN_FOLDER_CACHE_TTL, updated_func=None, wait=True):
+        """
+        Gets the names of all the folders in the run_folder on the cluster
+        and returs as a list.
+        Listings older than max_age are returned from the cache and refreshed in the background,
+        calling updated_func(run_folders) if they changed. See cached
+        """
+        return self.cached("run_folders:" + self.run_path, max_age, self.fetch_run_folders, updated_func, wait)
+    def fetch_run_folders(self):
+        """Lists the run_folder on the cluster"""
+        self.output("\nRetrieving run folders ...")
+        #use ls -1 {}| awk  '{$1=$2=""; print 0}' to get long form data but not very useful
+        run_folders = self.agent_call("list", path=self.run_path)
+        if run_folders is None:
+            run_folders = self.executor.run("ls -1 {}".format(self.run_path), coalesce=True).stdout.splitlines()
+
+        self.output("\tFound {} run folders".format(len(run_folders)))
+        return run_folders
+    def delete_run_folders(self, folderlist):
+        """Deletes the list of folders from the cluster"""
+        self.output("\nDeleting Run Folders ...", False)
+        for folder in folderlist:
+            self.output("\tDeleting {}".format(folder), False)
+            forget_uploads(self.remote_key(self.run_path+"/"+folder))
+        if self.agent_call("delete", paths=[self.run_path+"/"+folder for folder in folderlist]) is None:
+            for folder in folderlist:
+                self.executor.run("rm -rf {}".format(self.run_path+"/"+clean_path(folder)))
+        self.invalidate_cache("run_folders:" + self.run_path)
+        self.output("\tFinished Deleting", False)
+    def get_job_list(self, jobids=None, verbose=True):
+        """
+        Gets information about currently running jobs with a single bjobs call.
+        If jobids is given only those jobs are queried.
+        Returns a list of JobRecords
+        """
+        if verbose:
+            self.output("\nGetting job listing ...")
+        argv = ["bjobs", "-noheader", "-o", "{} delimiter='{}'".format(BJOBS_FIELDS, BJOBS_DELIMITER)]
+        #identical listings asked for at the same time share one bjobs call
+        result = self.run_lsf(argv + [str(jobid) for jobid in jobids or ()], coalesce=True)
+        if result.exit_status != 0:
+            #no jobs or jobs that are not found just leave an empty listing. Any other failure is raised
+            #so callers such as the status poller keep the last listing instead of dropping every job
+            errors = [line for line in result.stderr.splitlines() if line.strip() and
+                      "No unfinished job found" not in line and "is not found" not in line]
+            if errors or not result.stderr.strip():
+                raise RuntimeError("bjobs failed ({}): {}".format(result.exit_status, " ".join(errors)))
+
+        #pattern used to get model version and run folder from the job command.
+        #The folder ends at the first unescaped space or ; so commands following it are not included
+        command_pattern = re.compile(r"{}/.*?/(.*?)~/{}/((?:\\.|[^\s;])+)".format(re.escape(self.model_path),
+                                                                                 re.escape(self.run_path)))
+        job_data = []
+        #jobs as (record index, map file, array index) which get their run folder from the map file.
+        #Packed jobs have index 0 and run all folders of the map file
+        array_jobs = []
+        for line in result.stdout.splitlines():
+            fields = line.split(BJOBS_DELIMITER, 5)
+            if len(fields) != 6:
+                #not a job line (e.g. "No unfinished job found")
+                continue
+            jobid, jobindex, status, queue, job_name, command = [f.strip() for f in fields]
+            model_version = run_folder = ""
+            match = command_pattern.search(command)
+            if match:
+                model_version = match.group(1).strip()
+                run_folder = reverse_clean_path(match.group(2).strip())
+            if jobindex not in ("", "0", "-"):
+                #array elements are addressed as id[index] by bkill and bjobs
+                jobid = "{}[{}]".format(jobid, jobindex)
+            map_match = re.search(r"JOB_MAP=~/((?:\\.|[^\s;])+)", command)
+            if map_match:
+                #job arrays and packed jobs list their run folders in a map file
+                run_folder = ""
+                index = int(jobindex) if jobindex.isdigit() else 0
+                array_jobs.append((len(job_data), reverse_clean_path(map_match.group(1)), index))
+            job_data.append(JobRecord(jobid, status, queue, job_name, command, model_version, run_folder))
+
+        #resolve run folders of array elements
+        self.load_job_maps(set(map_file for index, map_file, jobindex in array_jobs))
+        for index, map_file, jobindex in array_jobs:
+            folders = self.job_maps.get(map_file, [])
+            if jobindex == 0:
+                job_data[index] = job_data[index]._replace(run_folder=", ".join(folders))
+            elif jobindex <= len(folders):
+                job_data[index] = job_data[index]._replace(run_folder=folders[jobindex-1])
+
+        return job_data
+    def load_job_maps(self, map_files):
+        """Reads the job array map files that are not known yet with a single call"""
+        map_files = [map_file for map_file in map_files if map_file not in self.job_maps]
+        if not map_files:
+            return
+        texts = self.agent_call("read", paths=map_files)
+        if texts is not None:
+            for map_file in map_files:
+                self.job_maps[map_file] = texts.get(map_file, "").splitlines()
+            return
+        result = self.executor.run(
+            "awk '{{print FILENAME \"\\t\" $0}}' {}".format(" ".join(clean_path(f) for f in map_files)), coalesce=True)
+        for map_file in map_files:
+            self.job_maps[map_file] = []
+        for line in result.stdout.splitlines():
+            map_file, sep, folder = line.partition("\t")
+            if map_file in self.job_maps:
+                self.job_maps[map_file].append(folder)
+    def get_job_info(self, jobid):
+        """
+        Returns the JobRecord for a single job or None if the job is not found.
+        Uses the same batched listing as get_job_list.
+        """
+        for job in self.get_job_list([jobid]):
+            if job.jobid == str(jobid):
+                return job
+        return None
+    def kill_jobs(self, joblist):
+        """Kills jobs with jobids given in joblist"""
+        self.output("\nKilling Jobs...", False)
+        #one bkill for all jobs, through the remote helper or a login shell
+        self.run_lsf(["bkill"] + [str(jobid) for jobid in joblist])
+        if self.status_poller:
+            #show the new state of the killed jobs
+            self.status_poller.poll_now()
+        self.output("\t {} jobs killed".format(len(joblist)), False)
+    def update_cluster_information(self):
+        """
+        Updates the names of all model versions along with model type(debug, treatm, transm)
+        Updates the lists of available queues
+        Should be called when logging in
+        """
+
+        self.output("\tRetrieving model and queue information...", False)
+        self.update_model_versions()
+        self.update_queues()
+        self.output("\tDone", False)
+    def update_model_versions(self, updated_func=None):
+        """
+        Updates the names of all model versions by model type from the cache.
+        Stale versions are refreshed in the background and updated_func() is called if they changed
+        """
+        def store(model_versions):
+            self.model_versions = model_versions
+            if updated_func:
+                updated_func()
+        self.model_versions = self.cached("model_versions:" + self.model_path, MODEL_VERSION_CACHE_TTL,
+                                          self.fetch_model_versions, store)
+    def fetch_model_versions(self):
+        """
+        Returns the names of all model versions by model type.
+        All versions are listed with one find call or pipelined requests to the remote helper
+        """
+        model_versions = None
+        model_types = self.agent_call("list", path=self.model_path)
+        if model_types is not None:
+            try:
+                #ask for all model types at once
+                futures = [(m_type, self.agent.request("list", path=self.model_path+"/"+m_type))
+                           for m_type in model_types]
+                model_versions = dict((m_type, future.result()) for m_type, future in futures)
+            except RemoteAgentError as e:
+                self.output("\tRemote helper failed ({}), using shell commands".format(e), False)
+        if model_versions is None:
+            #model types are at depth 1 and their versions at depth 2
+            result = self.executor.run("find -L {} -mindepth 1 -maxdepth 2 -printf '%P\\n'".format(
+                clean_path(self.model_path)), coalesce=True)
+            model_versions = {}
+            for line in sorted(result.stdout.splitlines()):
+                m_type, sep, m_version = line.partition("/")
+                model_versions.setdefault(m_type, [])
+                if m_version:
+                    model_versions[m_type].append(m_version)
+
+        self.output("\tFound {} model versions".format(sum(len(v) for v in model_versions.values())))
+        return model_versions
+    def update_queues(self, updated_func=None):
+        """
+        Updates the lists of available queues from the cache.
+        Stale queues are refreshed in the background and updated_func() is called if they changed
+        """
+        if CLUSTER_INFO[self.clustername]['default_queues']:
+            self.queues = CLUSTER_INFO[self.clustername]['default_queues']
+            return
+        def store(queues):
+            self.queues = queues
+            if updated_func:
+                updated_func()
+        self.queues = self.cached("queues", QUEUE_CACHE_TTL, self.fetch_queues, store)
+    def fetch_queues(self):
+        """Returns the names of the queues on the cluster"""
+        #Gets a list of queues by calling bqueues and filtering the output
+        result = self.run_lsf(["bqueues", "-w"], coalesce=True)
+        #skip the header line and keep the queue names
+        return [line.split()[0] for line in result.stdout.splitlines()[1:] if line.strip()]
+
+    def close_connection(self):
+        self.stop_status_poller()
+        self.stop_follower()
+        #downloads still queued or running would only fail once the pool is closed
+        for future in self.download_tasks:
+            future.cancel()
+        self.download_tasks = []
+        self.cache = None
+        if self.agent:
+            self.agent.close()
+            self.agent = None
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+            self.executor = None
+    def __del__(self):
+        #closes SSH connection upon exit
+        self.close_connection()
+     
+#---------------------------------------------
+# Helper function
+def is_alive(transport):
+    """Checks that a transport is still connected and authenticated"""
+    return transport.is_active() and transport.is_authenticated()
+
+#---------------------------------------------
+# Helper function
+def sftp_is_alive(sftp):
+    """Checks that a pooled sftp client can still be used"""
+    chan = sftp.get_channel()
+    return not chan.closed and is_alive(chan.get_transport())
+
+#---------------------------------------------
+# Helper function
+def forget_uploads(remote_key, cache_dir=CACHE_DIR):
+    """
+    Drops upload records for remote_key and everything below it from all manifests.
+    Used when folders are deleted from the cluster.
+    """
+    manifest_dir = os.path.join(cache_dir, "manifests")
+    if not os.path.isdir(manifest_dir):
+        return
+    for fname in os.listdir(manifest_dir):
+        path = os.path.join(manifest_dir, fname)
+        #a manifest saved in between would be lost
+        with JSON_LOCK:
+            data = read_json(path)
+            if not data:
+                continue
+            uploads = data.get("uploads", {})
+            stale = [key for key in uploads if key == remote_key or key.startswith(remote_key + "/")]
+            if stale:
+                for key in stale:
+                    del uploads[key]
+                write_json(path, data)
+
+#---------------------------------------------
+# Helper function
+def submission_tag():
+    """Returns a tag naming the files of one job submission, made from the current time to the millisecond"""
+    now = time.time()
+    return "{}_{:03d}".format(time.strftime("%Y%m%d_%H%M%S", time.localtime(now)), int(now*1000) % 1000)
+
+#---------------------------------------------
+# Helper function
+def pack_folders(folders, work, num_packs):
+    """
+    Splits folders into at most num_packs groups of about equal total work.
+    Folders are placed largest first on the least loaded group.
+    Returns the non empty groups with folders in their original order
+    """
+    num_packs = max(1, min(int(num_packs), len(folders)))
+    order = dict((folder, i) for i, folder in enumerate(folders))
+    packs = [[] for i in range(num_packs)]
+    loads = [0]*num_packs
+    for folder in sorted(folders, key=lambda f: -work.get(f, 0)):
+        i = loads.index(min(loads))
+        packs[i].append(folder)
+        loads[i] += work.get(folder, 0)
+    return [sorted(pack, key=order.get) for pack in packs if pack]
+
+#---------------------------------------------
+# Helper function
+def read_json(path):
+    """Reads a json file. Returns None if it is missing or unreadable"""
+    try:
+        with JSON_LOCK:
+            with open(path) as f:
+                return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+#---------------------------------------------
+# Helper function
+def write_json(path, data):
+    """Writes a json file by writing a unique temporary file next to it and moving it in place"""
+    with JSON_LOCK:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+#---------------------------------------------
+# Helper function
+def save_json(path, lock, snapshot):
+    """
+    Writes the data returned by snapshot, which is called holding lock, to a json file.
+    The snapshot is taken under JSON_LOCK as well so a newer copy is never overwritten by one taken earlier
+    """
+    with JSON_LOCK:
+        with lock:
+            data = snapshot()
+        write_json(path, data)
+
+#---------------------------------------------
+# Helper function
+def file_digest(path):
+    """Returns the sha256 hex digest of a local file, reading it in blocks"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+#---------------------------------------------
+# Helper function
+def is_safe_member(member):
+    """Only allows plain files and directories that stay inside the extraction folder"""
+    if not (member.isfile() or member.isdir()):
+        return False
+    parts = member.name.split("/")
+    return not (member.name.startswith("/") or ".." in parts or ":" in parts[0])
+
+#---------------------------------------------
+# Helper function
+def local_path_of(local_root, entry):
+    """Returns the local path of a RemoteEntry downloaded into local_root"""
+    return os.path.join(local_root, *entry.path.split("/"))
+
+#---------------------------------------------
+# Helper function
+def partial_path(path, mtime):
+    """
+    Path of the partial download of path.
+    The remote mtime is part of the name so a partial file is only continued if the remote file is unchanged.
+    """
+    return "{}.{}{}".format(path, int(mtime), PARTIAL_SUFFIX)
+
+#---------------------------------------------
+# Helper function
+def ranges_path(path, mtime):
+    """
+    Path of the partial file of a download of path in ranges.
+    It has its own name so a resume does not continue it, its size says nothing about what was written
+    """
+    return "{}.{}{}".format(path, int(mtime), RANGES_SUFFIX)
+
+#---------------------------------------------
+# Helper function
+def write_file(f, path, mtime, progress_func, offset=0):
+    """
+    Copies file object f to a partial file next to path, starting at offset,
+    and moves it in place with the given mtime once complete.
+    progress_func is called with the number of bytes written.
+    """
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    part = partial_path(path, mtime)
+    with open(part, "ab" if offset else "wb") as local_file:
+        for block in iter(lambda: f.read(TRANSFER_BLOCK_SIZE), b""):
+            local_file.write(block)
+            progress_func(len(block))
+    finish_partial(part, path, mtime)
+
+#---------------------------------------------
+# Helper function
+def find_filter_args(file_filter):
+    """
+    Returns the find expression, followed by a space, that selects the files of a FileFilter.
+    Anything that is not a regular file passes. Returns an empty string if there is no filter
+    """
+    if not file_filter:
+        return ""
+    tests = []
+    if file_filter.include:
+        tests.append("\\( " + " -o ".join("-name " + shell_quote(p) for p in file_filter.include) + " \\)")
+    tests += ["! -name " + shell_quote(p) for p in file_filter.exclude or ()]
+    if file_filter.max_size is not None:
+        tests.append("! -size +{}c".format(int(file_filter.max_size)))
+    if not tests:
+        return ""
+    return "\\( ! -type f -o \\( {} \\) \\) ".format(" ".join(tests))
+
+#---------------------------------------------
+# Helper function
+def filter_matches(file_filter, entry):
+    """Checks a file's RemoteEntry against a FileFilter the way find_filter_args does on the cluster"""
+    if not file_filter:
+        return True
+    name = posixpath.basename(entry.path)
+    if file_filter.include and not any(fnmatch.fnmatchcase(name, p) for p in file_filter.include):
+        return False
+    if any(fnmatch.fnmatchcase(name, p) for p in file_filter.exclude or ()):
+        return False
+    return file_filter.max_size is None or entry.size <= file_filter.max_size
+
+#---------------------------------------------
+# Helper function
+def input_folders(entries):
+    """Returns the set of folders of the RemoteEntry list entries that hold RUN_INPUT files"""
+    return set(posixpath.dirname(entry.path) for entry in entries
+               if entry.type == "f" and glob_match(posixpath.basename(entry.path), RUN_INPUT))
+
+#---------------------------------------------
+# Helper function
+def archive_folder(path, run_folders):
+    """
+    Returns the innermost folder of run_folders containing the relative path, whose result archive
+    holds the file, or None if no run folder contains it
+    """
+    while path:
+        path = posixpath.dirname(path)
+        if path in run_folders:
+            return path
+    return None
+
+#---------------------------------------------
+# Helper function
+def is_result_file(path):
+    """Checks if a remote path is a result archive or manifest written by a job"""
+    return posixpath.basename(path) in (RESULT_ARCHIVE, RESULT_MANIFEST)
+
+#---------------------------------------------
+# Helper function
+def sftp_makedirs(sftp, path, created):
+    """
+    Creates the remote folder path and any missing parents over sftp.
+    created is a set of folders known to exist and is updated.
+    """
+    if path in created or path in ("", ".", "/"):
+        return
+    try:
+        sftp.stat(path)
+    except IOError:
+        sftp_makedirs(sftp, posixpath.dirname(path), created)
+        sftp.mkdir(path)
+    created.add(path)
+
+#---------------------------------------------
+# Helper function
+def walk_files(root):
+    """
+    Walks the folder tree below root top down like os.walk.
+    Yields tuples (folder, names of the files in it). Uses scandir where available
+    so file types come from the directory listing without a stat per file.
+    """
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(root):
+            yield dirpath, filenames
+        return
+    folders = [root]
+    while folders:
+        dirpath = folders.pop()
+        filenames = []
+        subfolders = []
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                #like os.walk, links to folders are not followed
+                if not entry.is_symlink():
+                    subfolders.append(entry.path)
+            else:
+                filenames.append(entry.name)
+        yield dirpath, filenames
+        folders.extend(reversed(subfolders))
+
+#---------------------------------------------
+# Helper function
+def glob_match(name, pattern):
+    """Matches a file name against a glob pattern the way glob.glob does, hidden files need a leading dot"""
+    if name.startswith(".") and not pattern.startswith("."):
+        return False
+    return fnmatch.fnmatch(name, pattern)
+
+#---------------------------------------------
+# Helper function
+def finish_partial(part, path, mtime):
+    """Moves a completed partial file in place with the given mtime"""
+    os.utime(part, (mtime, mtime))
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(part, path)
+
+#---------------------------------------------
+# Helper function
+def split_ranges(size, range_size):
+    """Splits size bytes into a list of tuples (start, length) of at most range_size bytes"""
+    return [(start, min(range_size, size - start)) for start in range(0, size, range_size)]
+
+#---------------------------------------------
+# Helper function
+def copy_range(src, dst, length, progress_func):
+    """
+    Copies length bytes from file object src to dst at their current positions.
+    progress_func is called with the number of bytes written.
+    """
+    while length > 0:
+        block = src.read(min(TRANSFER_BLOCK_SIZE, length))
+        if not block:
+            raise IOError("File ended {} bytes early".format(length))
+        dst.write(block)
+        progress_func(len(block))
+        length -= len(block)
+
+#---------------------------------------------
+# Helper function
+def format_bytes(num_bytes):
+    """Formats a byte count or rate for display"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024:
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return "{:.1f} TB".format(num_bytes)
+
+#---------------------------------------------
+# Helper function
+def format_eta(seconds):
+    """Formats a number of seconds as h:mm:ss"""
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    return "{}:{:02d}".format(minutes, seconds)
+
+#---------------------------------------------
+# Helper function
+def to_text(data):
+    """Returns remote output as text. paramiko gives bytes on python 3"""
+    if not isinstance(data, str):
+        data = data.decode("utf-8", "replace")
+    return data
+
+#---------------------------------------------
+# Helper function
+def to_bytes(data):
+    """Encodes text for sending to the cluster"""
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return data
+
+#---------------------------------------------
+# Helper function
+def shell_quote(text):
+    """Quotes text as a single shell word"""
+    return "'" + text.replace("'", "'\\''") + "'"
+
+#---------------------------------------------
+# Helper function
+def clean_path(path):
+    """Cleans a filepath for use on cluster by adding escape characters"""
+    esc_chars = ['&',';','(',')','$','`','\'',' ']
+    for c in esc_chars:
+        path = path.replace(c, "\\"+c)
+    return path
+
+#---------------------------------------------
+# Helper function
+def reverse_clean_path(path):
+    """Removes escape characters from path"""
+    return path.replace("\\","")
+
+
+        
+#---------------------------------------------
+
+        
+#---------------------------------------------
+
+    
+#----------------------------------------------------------------------
+if __name__ == "__main__":
+    hostname = 'erisone.partners.org'
+    username = 'kh398'
+    password = getpass.getpass("Password: ")
+    port = 22
+    glob_pattern='*.*' # can be used to only copy a specific type of file, e.g. '.in'
+
+    lsfinfo = {
+    'email'        : "khoeffner@mgh.harvard.edu",
+    'modelversion' : "cepac45c",
+    'jobname'      : "R6",
+    'queue'        : "medium"    
+    }
+
+    dir_local = 'Z:\CEPAC - International\Projects\Hoeffner\Ongoing Projects\DTG-1stART-RLS\Analysis\DEV0\Run1_3\R6'
+    dir_remote = "runs/" + lsfinfo['jobname']
+
+    if sys.argv[1].lower() == 'upload':
+        with paramiko.Transport((hostname, port)) as t:
+            t.connect(username=username, password=password)
+            sftp = t.open_session()
+            sftp = paramiko.SFTPClient.from_transport(t)
+            jobfiles = sftp_upload(dir_local, dir_remote, glob_pattern, lsfinfo, sftp)
+
+        if len(sys.argv) > 2 and sys.argv[2].lower() == 'submit':        
+            with paramiko.SSHClient() as ssh:
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                ssh.connect(hostname, username=username, password=password)
+                pybsub(jobfiles, ssh)
+                
+    
+    if sys.argv[1].lower() == 'status':
+        # Get job status
+        with paramiko.SSHClient() as ssh:
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(hostname, username=username, password=password)
+            stdin, stdout, stderr = ssh.exec_command("bjobs")
+            if stdout.readlines():
+                for line in stdout.readlines():
+                    print(line.split())
+            else:
+                print(stderr.readlines())  
+            
+    if sys.argv[1].lower() == 'download':            
+    # Download everything - Use this after the runs are done
+        with paramiko.Transport((hostname, port)) as t:
+            t.connect(username=username, password=password)
+            t.use_compression() 
+            sftp = t.open_session()
+            sftp = paramiko.SFTPClient.from_transport(t)
+            sftp_get_recursive(dir_remote, dir_local, sftp)
+            print("Download complete!")
+
+    
+# Download everything in a zip file - Still needs to be fixed because the path is wrong
+#    with paramiko.SSHClient() as ssh:
+#        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+#        ssh.connect(hostname, username=username, password=password)
+#        stdin, stdout, stderr = ssh.exec_command("zip -9 -y -r -q ~/runs/R500.zip "+dir_remote)
+#    
+#        if not stdout.readlines():
+#            with paramiko.Transport((hostname, port)) as t:
+#                t.connect(username=username, password=password)
+#                t.use_compression() 
+#                sftp = t.open_session()
+#                sftp = paramiko.SFTPClient.from_transport(t)
+#                # This should be stored somewhere locally for faster access!
+#                dir_local='C:\MyTemp'
+#                sftp.get("runs/R500.zip", dir_local+"\R500.zip")
+#                print("Download complete!")
+#    
+#            stdin, stdout, stderr = ssh.exec_command("rm runs/R500.zip")
+#    
+#    print("Extracting files")
+#    with zipfile.ZipFile(dir_local+"\R500.zip", "r") as z:
+#        z.extractall(dir_local)    
+    
@@ -8,13 +8,24 @@ Author: Taige Hou (thou1@partners.org)
 import wx, threading
 from wx.lib.agw import aui
 import wx.lib.mixins.listctrl as listmix
-import wx.lib.agw.ultimatelistctrl as ULC
 from wx.lib.embeddedimage import PyEmbeddedImage
 import EnhancedStatusBar
-from CEPACClusterLib import CEPACClusterApp, CLUSTER_NAMES, CLUSTER_INFO, JobInfoThread
+import os
+from CEPACClusterLib import CEPACClusterApp, LogBuffer, CLUSTER_NAMES, CLUSTER_INFO, CACHE_DIR, \
+     RUN_FOLDER_CACHE_TTL, FileFilter, format_bytes, format_eta
 
 #----------------------------------------------------------------------
 MAIN_WINDOW_SIZE = (850,720)
+#Milliseconds between moving buffered output into the output box and the most lines moved at once
+OUTPUT_REFRESH_MS = 100
+OUTPUT_BATCH_LINES = 1000
+#Lines kept in the output box. Older lines are only in the output log file
+OUTPUT_MAX_LINES = 3000
+#Lines kept in the viewer of a followed job's output
+FOLLOW_MAX_LINES = 2000
+#Number of characters in the text progress bars and width of the progress column
+PROGRESS_CELLS = 20
+PROGRESS_WIDTH = 220
 OUTPUT_FONT = (10.5, wx.FONTFAMILY_SWISS,
                wx.FONTSTYLE_NORMAL,
                wx.FONTWEIGHT_NORMAL)
@@ -30,14 +41,138 @@ ICON = PyEmbeddedImage(
 
 
 ########################################################################
-"""Custom event to signal that output should be written"""
-(OutputEvent, EVT_OUTPUT) = wx.lib.newevent.NewEvent()
-"""Custom event to update the job info"""
-(JobEvent, EVT_JOB) = wx.lib.newevent.NewEvent()
+"""Custom event carrying the jobs added, changed and removed since the last status poll"""
+(JobDiffEvent, EVT_JOB_DIFF) = wx.lib.newevent.NewEvent()
 """Custom event to update the progress gauge for uploads"""
 (UpdateUploadEvent, EVT_UPDATE_UPLOAD) = wx.lib.newevent.NewEvent()
 """Custom event to update the progress gauge for downloads"""
 (UpdateDownloadEvent, EVT_UPDATE_DOWNLOAD) = wx.lib.newevent.NewEvent()
+"""Custom event carrying the combined progress of all transfers"""
+(TransferRateEvent, EVT_TRANSFER_RATE) = wx.lib.newevent.NewEvent()
+"""Custom event sent when login has succeeded or failed"""
+(LoginEvent, EVT_LOGIN) = wx.lib.newevent.NewEvent()
+"""Custom event sent when model versions or queues have been loaded"""
+(ClusterInfoEvent, EVT_CLUSTER_INFO) = wx.lib.newevent.NewEvent()
+"""Custom event carrying a refreshed list of run folders"""
+(RunFoldersEvent, EVT_RUN_FOLDERS) = wx.lib.newevent.NewEvent()
+"""Custom event carrying text appended to a file of the followed job"""
+(JobOutputEvent, EVT_JOB_OUTPUT) = wx.lib.newevent.NewEvent()
+########################################################################
+class ListModel:
+    """
+    Rows of a VirtualList kept in flat arrays with an index from row key to row number.
+    Each row is a tuple of column texts. Rows are looked up by key in constant time.
+    """
+    def __init__(self):
+        #key and column texts of each row
+        self.keys = []
+        self.rows = []
+        #row number of each key
+        self.index = {}
+        #keys of checked rows
+        self.checked = set()
+        #download progress of rows that have any
+        self.progress = {}
+    def __len__(self):
+        return len(self.keys)
+    def set_rows(self, keys, rows):
+        """Replaces all rows"""
+        self.keys = list(keys)
+        self.rows = list(rows)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+        self.checked &= set(self.keys)
+        self.progress = dict((key, p) for key, p in self.progress.items() if key in self.index)
+    def append(self, key, row):
+        if key in self.index:
+            self.update(key, row)
+            return
+        self.index[key] = len(self.keys)
+        self.keys.append(key)
+        self.rows.append(row)
+    def update(self, key, row):
+        if key in self.index:
+            self.rows[self.index[key]] = row
+    def remove(self, keys):
+        """Removes the rows of keys. Compacts the arrays once for all of them"""
+        keys = set(key for key in keys if key in self.index)
+        if not keys:
+            return
+        kept = [i for i, key in enumerate(self.keys) if key not in keys]
+        self.set_rows([self.keys[i] for i in kept], [self.rows[i] for i in kept])
+    def row_of(self, key):
+        """Returns the row number of key or None"""
+        return self.index.get(key)
+    def toggle(self, row):
+        key = self.keys[row]
+        if key in self.checked:
+            self.checked.remove(key)
+        else:
+            self.checked.add(key)
+    def checked_keys(self):
+        """Returns the keys of the checked rows in row order"""
+        return [key for key in self.keys if key in self.checked]
+    def set_progress(self, key, progress):
+        self.progress[key] = progress
+
+########################################################################
+class VirtualList(wx.ListCtrl):
+    """
+    Report list that only asks its ListModel for the rows that are on screen.
+    The first column is a checkbox drawn from an image list and progress_col,
+    if given, shows the row's progress drawn as text instead of a gauge window.
+    """
+    def __init__(self, parent, model, columns, progress_col=None, **kwargs):
+        wx.ListCtrl.__init__(self, parent, -1,
+                             style=wx.LC_REPORT|wx.LC_VIRTUAL|wx.LC_VRULES|wx.LC_HRULES|wx.LC_SINGLE_SEL,
+                             **kwargs)
+        self.model = model
+        self.progress_col = progress_col
+        #checkbox images, unchecked then checked
+        self.images = wx.ImageList(16, 16)
+        for flags in (0, wx.CONTROL_CHECKED):
+            bmp = wx.EmptyBitmap(16, 16)
+            dc = wx.MemoryDC(bmp)
+            dc.SetBackground(wx.Brush(self.GetBackgroundColour()))
+            dc.Clear()
+            wx.RendererNative.Get().DrawCheckBox(self, dc, (1, 1, 14, 14), flags)
+            dc.SelectObject(wx.NullBitmap)
+            self.images.Add(bmp)
+        self.SetImageList(self.images, wx.IMAGE_LIST_SMALL)
+        self.InsertColumn(0, "", width=24)
+        for col, (title, width) in enumerate(columns, 1):
+            self.InsertColumn(col, title, wx.LIST_FORMAT_RIGHT, width)
+        self.Bind(wx.EVT_LEFT_DOWN, self.on_left_down)
+    def refresh_rows(self):
+        """Call after rows are added or removed. Only the visible rows are repainted"""
+        self.SetItemCount(len(self.model))
+        self.Refresh()
+    def refresh_key(self, key):
+        """Repaints the row of key"""
+        row = self.model.row_of(key)
+        if row is not None:
+            self.RefreshItem(row)
+    def OnGetItemText(self, item, col):
+        if col == 0:
+            return ""
+        if col == self.progress_col:
+            key = self.model.keys[item]
+            if key in self.model.progress:
+                return progress_text(self.model.progress[key])
+            return ""
+        return self.model.rows[item][col-1]
+    def OnGetItemImage(self, item):
+        return 1 if self.model.keys[item] in self.model.checked else 0
+    def OnGetItemAttr(self, item):
+        return None
+    def on_left_down(self, event):
+        """Toggles the checkbox of a row when its first column is clicked"""
+        item, flags = self.HitTest(event.GetPosition())
+        if item >= 0 and event.GetX() < self.GetColumnWidth(0):
+            self.model.toggle(item)
+            self.RefreshItem(item)
+        else:
+            event.Skip()
+
 ########################################################################
 class PanelNotebook(aui.AuiNotebook):
     """Custom class derived from AuiNotebook that handles clicks on tabs"""
@@ -91,6 +226,7 @@ class MainFrame(wx.Frame):
         #Hide close buttons
         for page_num in range(self.notebook.GetPageCount()):
             self.notebook.SetCloseButton(page_num,False)
+        self.Bind(aui.EVT_AUINOTEBOOK_PAGE_CHANGED, self.on_page_changed, self.notebook)
 
         #Text box used to print messages from Cluster App
         self.output_box = wx.TextCtrl(self, -1,
@@ -98,16 +234,13 @@ class MainFrame(wx.Frame):
         self.output_box.SetFont(wx.Font(*OUTPUT_FONT))
         
         #Bind output box to Cluster App.
-        #If called from worker thread, we post an event to the output box
-        #Otherwise write directly to output box
-        def gen_evt_func(text, is_thread = True):
-            if is_thread:
-                evt = OutputEvent(message = text)
-                wx.PostEvent(self, evt)
-            else:
-                self.on_output(None, text)
-        #print_func = lambda text:self.output_box.AppendText(text+"\n")
-        self.cluster.bind_output(gen_evt_func)
+        #All threads write to a buffer which a timer moves into the output box in batches.
+        #The full output is kept in a rotating log file
+        self.log = LogBuffer(spill_path=os.path.join(CACHE_DIR, "output.log"))
+        self.cluster.bind_output(self.log.write)
+        self.output_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_output, self.output_timer)
+        self.output_timer.Start(OUTPUT_REFRESH_MS)
         
         self._mgr.AddPane(self.notebook, aui.AuiPaneInfo().Name("notebook_content").CenterPane().CloseButton(False))
         self._mgr.AddPane(self.output_box, aui.AuiPaneInfo().Name("output").
@@ -120,13 +253,11 @@ class MainFrame(wx.Frame):
         
         #commit changes
         self._mgr.Update()
-
-        self.Bind(EVT_OUTPUT, self.on_output)
     def setup_statusbar(self):
         self.statusbar = EnhancedStatusBar.EnhancedStatusBar(self)
         self.statusbar.GetParent().SendSizeEvent()
-        self.statusbar.SetFieldsCount(3)
-        self.statusbar.SetStatusWidths([55,150,40])
+        self.statusbar.SetFieldsCount(4)
+        self.statusbar.SetStatusWidths([55,150,40,220])
         self.upload_gauge = wx.Gauge(self.statusbar, -1, size = (150,-1))
         #Add progress gauge to upload panel
         self.upload_panel.add_gauge(self.upload_gauge)
@@ -135,19 +266,49 @@ class MainFrame(wx.Frame):
         self.statusbar.AddWidget(wx.StaticText(self.statusbar, -1, "Upload"))
         self.statusbar.AddWidget(self.upload_gauge)
         self.statusbar.AddWidget(self.abort_upload_btn)
+        #rate and time left of all running transfers
+        self.rate_text = wx.StaticText(self.statusbar, -1, "")
+        self.statusbar.AddWidget(self.rate_text)
         self.SetStatusBar(self.statusbar)
 
         self.Bind(wx.EVT_BUTTON, self.on_abort_upload, self.abort_upload_btn)
-    def on_output(self, event, text = ""):
-        """Called to print text to the output box"""
-        if event:
-            self.output_box.AppendText(event.message+"\n")
+        #progress reports come from the transfer threads
+        def rate_evt_func(info, aggregate):
+            wx.PostEvent(self, TransferRateEvent(aggregate = aggregate))
+        self.rate_evt_func = rate_evt_func
+        self.cluster.progress.subscribe(rate_evt_func)
+        self.Bind(EVT_TRANSFER_RATE, self.on_transfer_rate)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+    def on_output(self, event):
+        """Called by the output timer to move buffered text to the output box"""
+        lines, dropped = self.log.drain(OUTPUT_BATCH_LINES)
+        if not lines and not dropped:
+            return
+        text = "\n".join(lines) + "\n"
+        if dropped:
+            text = "... {} lines skipped, see the output log ...\n".format(dropped) + text
+        self.output_box.AppendText(text)
+        trim_lines(self.output_box, OUTPUT_MAX_LINES)
+    def on_page_changed(self, event):
+        """Shows the cached run folders when the download tab is opened"""
+        if self.notebook.GetPage(event.GetSelection()) is self.download_panel and self.cluster.cache:
+            self.download_panel.load_run_folders(RUN_FOLDER_CACHE_TTL)
+        event.Skip()
+    def on_transfer_rate(self, event):
+        """Shows the combined rate and time left of the running transfers"""
+        aggregate = event.aggregate
+        if aggregate.done_bytes < aggregate.total_bytes:
+            self.rate_text.SetLabel("{}/s, {} left".format(format_bytes(aggregate.rate), format_eta(aggregate.eta)))
         else:
-            self.output_box.AppendText(text+"\n")
+            self.rate_text.SetLabel("")
+    def on_close(self, event):
+        """Stops the transfer threads reporting to the closed window"""
+        self.cluster.progress.unsubscribe(self.rate_evt_func)
+        event.Skip()
     def on_abort_upload(self, event):
-        if self.cluster.upload_thread:
-            self.cluster.upload_thread.stop()
-            self.output_box.AppendText("\tUpload Stopped\n")
+        if self.cluster.upload_task and not self.cluster.upload_task.done():
+            self.cluster.upload_task.cancel()
+            self.log.write("\tUpload Stopped")
 ########################################################################
 class LoginPanel(wx.Panel):
     """Panel that handles login to the cluster"""
@@ -165,7 +326,8 @@ class LoginPanel(wx.Panel):
                                         
         self.username_tc = wx.TextCtrl(self, -1,)
         self.password_tc = wx.TextCtrl(self, -1, style=wx.TE_PASSWORD)
-        login_btn = wx.Button(self, 10, "Login")
+        self.use_agent_cb = wx.CheckBox(self, -1, "Use remote helper")
+        self.login_btn = wx.Button(self, 10, "Login")
         
         #Sets the default cluster information on init
         self.on_change_host(None)
@@ -183,10 +345,13 @@ class LoginPanel(wx.Panel):
         gbs.Add(self.username_tc, (2,1))
         gbs.Add(wx.StaticText(self, -1, "Password:"), (3,0))
         gbs.Add(self.password_tc, (3,1))
-        gbs.Add(login_btn, (4,2))
+        gbs.Add(self.use_agent_cb, (3,2))
+        gbs.Add(self.login_btn, (4,2))
 
         self.Bind(wx.EVT_COMBOBOX, self.on_change_host, self.cluster_cb)
-        self.Bind(wx.EVT_BUTTON, self.on_login,login_btn)
+        self.Bind(wx.EVT_BUTTON, self.on_login,self.login_btn)
+        self.Bind(EVT_LOGIN, self.on_login_done)
+        self.Bind(EVT_CLUSTER_INFO, self.on_cluster_info)
         self.password_tc.Bind(wx.EVT_KEY_UP, self.on_keypress)
         self.SetSizer(gbs)
 
@@ -198,17 +363,27 @@ class LoginPanel(wx.Panel):
         self.modelfolder_tc.SetValue(CLUSTER_INFO[cluster_name]['model_folder'])
     def on_login(self, event):
         """
-        Calls the ClusterApp connect function
+        Queues login to the cluster
+        The window stays responsive while model versions and queues are loaded
         """
-
+        if not self.login_btn.IsEnabled():
+            return
         hostname = self.hostname_tc.GetValue()
         username = self.username_tc.GetValue()
         password = self.password_tc.GetValue()
         run_path = self.runfolder_tc.GetValue()
         model_path = self.modelfolder_tc.GetValue()
         clustername = self.cluster_cb.GetValue()
-        self.cluster.connect(hostname, username, password, run_path, model_path, clustername)
-
+        self.login_btn.Disable()
+        self.cluster.create_connect_task(hostname, username, password, run_path, model_path, clustername,
+                                         lambda success: wx.PostEvent(self, LoginEvent(success=success)),
+                                         lambda: wx.PostEvent(self, ClusterInfoEvent()),
+                                         use_agent=self.use_agent_cb.GetValue())
+    def on_login_done(self, event):
+        """Called when login has finished"""
+        self.login_btn.Enable()
+    def on_cluster_info(self, event):
+        """Called when model versions or queues arrive"""
         #refill fields on other tabs with new cluster information
         self.parent.upload_panel.refill_fields()
     def on_keypress(self, event):
@@ -231,6 +406,10 @@ class UploadPanel(wx.Panel):
         self.email_tc = wx.TextCtrl(self, -1, size=(200,-1))
         self.jobname_tc = wx.TextCtrl(self, -1, size=(170,-1))
         self.local_dir_tc = wx.TextCtrl(self, -1, size=(600,-1))
+        self.job_array_cb = wx.CheckBox(self, -1, "Submit as job array")
+        self.compress_results_cb = wx.CheckBox(self, -1, "Compress results on the cluster")
+        self.pack_jobs_sc = wx.SpinCtrl(self, -1, size=(80,-1), min=0, max=10000, initial=0)
+        self.pack_parallel_sc = wx.SpinCtrl(self, -1, size=(80,-1), min=1, max=64, initial=1)
         browse_btn = wx.Button(self, 20, "...")                         
         upload_btn = wx.Button(self, 10, "Submit")
 
@@ -250,8 +429,14 @@ class UploadPanel(wx.Panel):
         gbs.Add(self.jobname_tc, (4,1))
         gbs.Add(self.local_dir_tc, (5,1))
         gbs.Add(browse_btn, (5,2))
+        gbs.Add(self.job_array_cb, (6,1))
+        gbs.Add(self.compress_results_cb, (6,2))
+        gbs.Add(wx.StaticText(self, -1, "Pack Into Jobs (0 = off)"),(7,0))
+        gbs.Add(self.pack_jobs_sc, (7,1))
+        gbs.Add(wx.StaticText(self, -1, "Parallel Runs Per Job"),(8,0))
+        gbs.Add(self.pack_parallel_sc, (8,1))
 
-        gbs.Add(upload_btn, (6,0))
+        gbs.Add(upload_btn, (9,0))
 
         self.Bind(wx.EVT_COMBOBOX, self.on_select_model_type, self.model_type_cb)
         self.Bind(wx.EVT_BUTTON, self.on_browse, browse_btn)
@@ -301,6 +486,13 @@ class UploadPanel(wx.Panel):
                    'modelversion': self.model_version_cb.GetValue()}
         if self.email_tc.GetValue():
             lsfinfo['email'] = self.email_tc.GetValue()
+        if self.job_array_cb.GetValue():
+            lsfinfo['job_array'] = True
+        if self.compress_results_cb.GetValue():
+            lsfinfo['compress_results'] = True
+        if self.pack_jobs_sc.GetValue():
+            lsfinfo['pack_jobs'] = self.pack_jobs_sc.GetValue()
+            lsfinfo['pack_parallel'] = self.pack_parallel_sc.GetValue()
 
         def update_func(progress):
             evt = UpdateUploadEvent(progress = progress)
@@ -309,8 +501,8 @@ class UploadPanel(wx.Panel):
         pattern = "*.in"
         if lsfinfo['modeltype']=="smoking":
             pattern="*.xlsx"
-        self.cluster.create_upload_thread(dir_local, dir_remote,
-                                          lsfinfo, update_func,pattern)
+        self.cluster.create_upload_task(dir_local, dir_remote,
+                                        lsfinfo, update_func,pattern)
         #jobfiles = self.cluster.sftp_upload(dir_local, dir_remote, lsfinfo)
         
         #submit jobs
@@ -336,20 +528,31 @@ class DownloadPanel(wx.Panel):
         #This is required to fix a bug with GenericDirCtrl in this version of wx
         self.local = wx.Locale(wx.LANGUAGE_ENGLISH)
 
-        #dict of progress gauges mapping folder names to gauges
-        self.gauges = {}
-        
+        #Run folders on the cluster keyed by folder name
+        self.folder_model = ListModel()
         #List Control of base run folder on cluster
-        self.remote_browser = ULC.UltimateListCtrl(self, -1, size = (-1,300),
-                                                   agwStyle=wx.LC_REPORT|wx.LC_VRULES|wx.LC_HRULES
-                                                   |wx.LC_SINGLE_SEL|ULC.ULC_AUTO_CHECK_CHILD) 
+        self.remote_browser = VirtualList(self, self.folder_model,
+                                          [("Run Folder", 300), ("Progress", PROGRESS_WIDTH)],
+                                          progress_col=2, size = (-1,300))
         self.refresh_remote_btn = wx.Button(self, 10, "Refresh")
         self.download_btn = wx.Button(self, 20, "Download")
         self.delete_btn = wx.Button(self, 30, "Delete")
+        #Only files matching the filter are downloaded. Patterns are separated by commas
+        self.include_tc = wx.TextCtrl(self, -1, size=(150,-1))
+        self.exclude_tc = wx.TextCtrl(self, -1, size=(150,-1))
+        self.max_size_sc = wx.SpinCtrl(self, -1, size=(80,-1), min=0, max=1000000, initial=0)
         
         #Layout
+        filter_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        filter_sizer.Add(wx.StaticText(self, -1, "Include"), 0, wx.ALIGN_CENTER_VERTICAL|wx.RIGHT, 5)
+        filter_sizer.Add(self.include_tc, 0, wx.RIGHT, 15)
+        filter_sizer.Add(wx.StaticText(self, -1, "Exclude"), 0, wx.ALIGN_CENTER_VERTICAL|wx.RIGHT, 5)
+        filter_sizer.Add(self.exclude_tc, 0, wx.RIGHT, 15)
+        filter_sizer.Add(wx.StaticText(self, -1, "Max Size MB (0 = any)"), 0, wx.ALIGN_CENTER_VERTICAL|wx.RIGHT, 5)
+        filter_sizer.Add(self.max_size_sc, 0)
         flex = wx.FlexGridSizer(cols = 1)
         flex.Add(self.remote_browser, 0, wx.EXPAND)
+        flex.Add(filter_sizer, 0)
         flex.Add(self.refresh_remote_btn, 0)
         flex.Add(self.download_btn,0)
         flex.Add(self.delete_btn,0)
@@ -359,63 +562,43 @@ class DownloadPanel(wx.Panel):
         self.Bind(wx.EVT_BUTTON, self.on_download, self.download_btn)
         self.Bind(wx.EVT_BUTTON, self.on_delete, self.delete_btn)
         self.Bind(EVT_UPDATE_DOWNLOAD, self.on_update_download)
+        self.Bind(EVT_RUN_FOLDERS, self.on_run_folders)
         self.SetSizer(flex)
     def on_refresh(self, event):
         """Refresh the list of Run folders on the cluster"""
-        self.remote_browser.ClearAll()
-
-        #Add Column Headers
-        info = ULC.UltimateListItem()
-        info._mask = ULC.ULC_MASK_CHECK
-        info._kind = 1
-        info._footerFont = None
-        self.remote_browser.InsertColumnInfo(0, info)
-        
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Run Folder"
-        self.remote_browser.InsertColumnInfo(1, info)
-        
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Progress"
-        self.remote_browser.InsertColumnInfo(2, info)
-        
-        #Add data
-        for index,entry in enumerate(self.cluster.get_run_folders()):
-            run_folder = entry.strip()
-            #checkbox
-            self.remote_browser.InsertStringItem(index, "", it_kind=1)
-            #Directory name
-            self.remote_browser.SetStringItem(index, 1, run_folder)
-            self.remote_browser.SetStringItem(index, 2, "")
-            
-            self.gauges[run_folder] = wx.Gauge(self.remote_browser, -1, 100, style=wx.GA_HORIZONTAL|wx.GA_SMOOTH)
-            item = self.remote_browser.GetItem(index,2)
-            item.SetWindow(self.gauges[run_folder])
-            self.remote_browser.SetItem(item)
-            
-        #item = self.remote_browser.GetItem(1,1)
-        #item.SetWindow(self.gauge)
-        #self.remote_browser.SetItem(item)
-        self.remote_browser.SetColumnWidth(0,wx.LIST_AUTOSIZE)
-        self.remote_browser.SetColumnWidth(1,wx.LIST_AUTOSIZE)
-        self.remote_browser.SetColumnWidth(2,wx.LIST_AUTOSIZE)
+        self.load_run_folders(0)
+    def load_run_folders(self, max_age):
+        """
+        Shows the cached run folders at once.
+        Listings older than max_age seconds are fetched in the background and shown when they arrive
+        """
+        def updated_func(run_folders):
+            wx.PostEvent(self, RunFoldersEvent(run_folders = run_folders))
+        run_folders = self.cluster.get_run_folders(max_age, updated_func, wait=False)
+        if run_folders is not None:
+            self.show_run_folders(run_folders)
+    def on_run_folders(self, event):
+        self.show_run_folders(event.run_folders)
+    def show_run_folders(self, run_folders):
+        run_folders = [entry.strip() for entry in run_folders]
+        self.folder_model.set_rows(run_folders, [(run_folder,) for run_folder in run_folders])
+        self.remote_browser.refresh_rows()
     def on_update_download(self, event):
         """Handles updates to progress bars for downloads"""
-        run_folder = event.run_folder
-        if run_folder in self.gauges:
-            self.gauges[run_folder].SetValue(event.progress)
+        self.folder_model.set_progress(event.run_folder, event.progress)
+        self.remote_browser.refresh_key(event.run_folder)
+    def file_filter(self):
+        """Returns the FileFilter given by the filter fields or None if they are empty"""
+        include = [p.strip() for p in self.include_tc.GetValue().split(",") if p.strip()]
+        exclude = [p.strip() for p in self.exclude_tc.GetValue().split(",") if p.strip()]
+        max_size = self.max_size_sc.GetValue()*1024*1024 or None
+        if not (include or exclude or max_size):
+            return None
+        return FileFilter(include, exclude, max_size)
     def on_download(self, event):
         """Recursively Downloads the directories selected by user"""
         #Get paths of checked items
-        items_to_download = []
-        for row_index in range(self.remote_browser.GetItemCount()):
-            if self.remote_browser.GetItem(row_index, 0).IsChecked():
-                remote_path = self.remote_browser.GetItem(row_index,1).GetText()
-                items_to_download.append(remote_path)
+        items_to_download = self.folder_model.checked_keys()
     
         #Create Dir Dialog to pick local dir
         dir_local = None
@@ -433,17 +616,12 @@ class DownloadPanel(wx.Panel):
         if dir_local:
             for run_folder in items_to_download:
                 dir_remote = self.cluster.run_path+"/"+run_folder
-                self.cluster.create_download_thread(run_folder, dir_remote, dir_local, update_func)
+                self.cluster.create_download_task(run_folder, dir_remote, dir_local, update_func,
+                                                  file_filter=self.file_filter())
     def on_delete(self, event):
         """Deletes the directories selected by user"""
         #Get paths of checked items
-        items_to_delete = []
-        indices_to_delete = []
-        for row_index in range(self.remote_browser.GetItemCount()):
-            if self.remote_browser.GetItem(row_index, 0).IsChecked():
-                remote_path = self.remote_browser.GetItem(row_index,1).GetText()
-                items_to_delete.append(remote_path)
-                indices_to_delete.append(row_index)
+        items_to_delete = self.folder_model.checked_keys()
     
         #Confirm Delete
         if items_to_delete:
@@ -452,10 +630,8 @@ class DownloadPanel(wx.Panel):
                                    wx.OK | wx.CANCEL)
             if dlg.ShowModal() == wx.ID_OK:
                 self.cluster.delete_run_folders(items_to_delete)
-                #reverse sort the indices so we dont run into trouble while deleting from for loop
-                indices_to_delete.reverse()
-                for index in indices_to_delete:
-                    self.remote_browser.DeleteItem(index)
+                self.folder_model.remove(items_to_delete)
+                self.remote_browser.refresh_rows()
             dlg.Destroy()
 
 ########################################################################        
@@ -465,118 +641,72 @@ class StatusPanel(wx.Panel):
         wx.Panel.__init__(self, parent)
         self.cluster = cluster
         
-        #List Control of base run folder on cluster
-        self.job_browser = ULC.UltimateListCtrl(self, -1, size = (-1,300),
-                                                   agwStyle=wx.LC_REPORT|wx.LC_VRULES|wx.LC_HRULES
-                                                   |wx.LC_SINGLE_SEL|ULC.ULC_AUTO_CHECK_CHILD)
+        #Jobs keyed by job id
+        self.job_model = ListModel()
+        #List Control of jobs on cluster
+        self.job_browser = VirtualList(self, self.job_model,
+                                       [("ID", 90), ("Status", 60), ("Queue", 80), ("Job Name", 120),
+                                        ("Model", 120), ("Folder", 250)],
+                                       size = (-1,300))
         self.refresh_btn = wx.Button(self, 10, "Refresh")
         self.kill_btn = wx.Button(self, 30, "Kill")
+        self.follow_btn = wx.Button(self, 40, "Follow Output")
+        self.stop_follow_btn = wx.Button(self, 50, "Stop Following")
+        #Shows the output files of the followed job as they are written
+        self.follow_box = wx.TextCtrl(self, -1, size = (-1,200),
+                                      style=wx.TE_MULTILINE|wx.TE_READONLY|wx.TE_DONTWRAP)
+        #file whose text was shown last
+        self.follow_path = None
         #Layout
+        btn_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        btn_sizer.Add(self.follow_btn, 0, wx.RIGHT, 5)
+        btn_sizer.Add(self.stop_follow_btn, 0)
         flex = wx.FlexGridSizer(cols = 1)
         flex.Add(self.job_browser, 0, wx.EXPAND)
         flex.Add(self.refresh_btn, 0)
         flex.Add(self.kill_btn, 0)
+        flex.Add(btn_sizer, 0)
+        flex.Add(self.follow_box, 0, wx.EXPAND)
         flex.AddGrowableCol(0)
 
         self.Bind(wx.EVT_BUTTON, self.on_refresh, self.refresh_btn)
         self.Bind(wx.EVT_BUTTON, self.on_kill, self.kill_btn)
-        self.Bind(EVT_JOB, self.on_job)
+        self.Bind(wx.EVT_BUTTON, self.on_follow, self.follow_btn)
+        self.Bind(wx.EVT_BUTTON, self.on_stop_follow, self.stop_follow_btn)
+        self.Bind(EVT_JOB_DIFF, self.on_job_diff)
+        self.Bind(EVT_JOB_OUTPUT, self.on_job_output)
         
         self.SetSizer(flex)
     def on_refresh(self, event):
-        """Refresh the list of jobs"""
-        self.job_browser.ClearAll()
-
-        #Add Column Headers
-        info = ULC.UltimateListItem()
-        info._mask = ULC.ULC_MASK_CHECK
-        info._kind = 1
-        info._footerFont = None
-        self.job_browser.InsertColumnInfo(0, info)
-        
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "ID"
-        self.job_browser.InsertColumnInfo(1, info)
-
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Status"
-        self.job_browser.InsertColumnInfo(2, info)
-
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Queue"
-        self.job_browser.InsertColumnInfo(3, info)
-
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Job Name"
-        self.job_browser.InsertColumnInfo(4, info)
-
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Model"
-        self.job_browser.InsertColumnInfo(5, info)
-        jobids = []
-        
-        info = ULC.UltimateListItem()
-        info._format = wx.LIST_FORMAT_RIGHT
-        info._mask = wx.LIST_MASK_TEXT
-        info._text = "Folder"
-        self.job_browser.InsertColumnInfo(6, info)
-        
-        #Add basic data
-        for index,job_data in enumerate(self.cluster.get_job_list()):
-            jobid, status, queue = job_data
-            jobids.append(jobid)
-            #checkbox
-            self.job_browser.InsertStringItem(index, "", it_kind=1)
-            self.job_browser.SetStringItem(index, 1, jobid)
-            self.job_browser.SetStringItem(index, 2, status)
-            self.job_browser.SetStringItem(index, 3, queue)
-
-        #Function to be passed to the job thread
-        def job_evt_func(jobid, data):
-            evt = JobEvent(jobid=jobid, data = data)
+        """Starts the background job poller or asks it for a poll right away"""
+        poller = self.cluster.status_poller
+        if poller and poller.running():
+            poller.poll_now()
+            return
+
+        #The list is rebuilt from the poller's first poll
+        self.job_model.set_rows([], [])
+        self.job_browser.refresh_rows()
+
+        #Function to be passed to the poller. Called from the poller thread
+        def job_diff_func(added, changed, removed):
+            evt = JobDiffEvent(added = added, changed = changed, removed = removed)
             wx.PostEvent(self, evt)
-            
-        #Add detailed data
-        for index, jobid in enumerate(jobids):
-            #create Job thread
-            job_thread = JobInfoThread(self.cluster, jobid, job_evt_func)
-            job_thread.start()
-            import time
-            time.sleep(.01)
-
-    def on_job(self, event):
-        """Updates display with detailed job info"""
-        jobid = event.jobid
-        job_info = event.data
-        if job_info:
-            for index in range(self.job_browser.GetItemCount()):
-                if str(self.job_browser.GetItem(index, 1).GetText()) == str(jobid):
-                    job_name, model_version, run_folder = job_info
-                    self.job_browser.SetStringItem(index, 4, job_name)
-                    self.job_browser.SetStringItem(index, 5, model_version)
-                    self.job_browser.SetStringItem(index, 6, run_folder)
-        for i in range(self.job_browser.GetColumnCount()):
-            self.job_browser.SetColumnWidth(i,wx.LIST_AUTOSIZE)
+
+        #All job details are fetched with a single call per poll
+        self.cluster.start_status_poller(job_diff_func)
+    def on_job_diff(self, event):
+        """Applies the changes reported by the poller to the model and repaints the visible rows"""
+        self.job_model.remove([job.jobid for job in event.removed])
+        for job in event.changed:
+            self.job_model.update(job.jobid, job_row(job))
+        for job in event.added:
+            self.job_model.append(job.jobid, job_row(job))
+        self.job_browser.refresh_rows()
     def on_kill(self, event):
         """Deletes the directories selected by user"""
         #Get paths of checked items
-        jobs = []
-        job_indices = []
-        for row_index in range(self.job_browser.GetItemCount()):
-            if self.job_browser.GetItem(row_index, 0).IsChecked():
-                jobid = self.job_browser.GetItem(row_index,1).GetText()
-                jobs.append(jobid)
-                job_indices.append(row_index)
+        jobs = self.job_model.checked_keys()
     
         #Confirm Delete
         if jobs:
@@ -584,12 +714,57 @@ class StatusPanel(wx.Panel):
                                    "Kill Jobs",
                                    wx.OK | wx.CANCEL)
             if dlg.ShowModal() == wx.ID_OK:
+                #the poller picks up the new state of the killed jobs
                 self.cluster.kill_jobs(jobs)
-                #reverse sort the indices so we dont run into trouble while deleting from for loop
-                job_indices.reverse()
-                for index in job_indices:
-                    self.job_browser.DeleteItem(index)
             dlg.Destroy()
+    def on_follow(self, event):
+        """Follows the output files of the first selected job"""
+        jobs = self.job_model.checked_keys()
+        if not jobs:
+            return
+        self.follow_box.Clear()
+        self.follow_path = None
+
+        #Function to be passed to the follower. Called from the follower thread
+        def data_func(path, text):
+            wx.PostEvent(self, JobOutputEvent(path = path, text = text))
+
+        #Only the bytes appended to the files are fetched on each poll
+        self.cluster.create_follow_task(jobs[0], data_func)
+    def on_stop_follow(self, event):
+        self.cluster.stop_follower()
+    def on_job_output(self, event):
+        """Appends text of a followed file to the viewer with a header when the file changes"""
+        if event.path != self.follow_path:
+            self.follow_path = event.path
+            self.follow_box.AppendText("\n==> {} <==\n".format(event.path))
+        self.follow_box.AppendText(event.text)
+        trim_lines(self.follow_box, FOLLOW_MAX_LINES)
+
+#----------------------------------------------------------------------
+# Helper function
+def job_row(job):
+    """Returns the column texts of a JobRecord"""
+    return (job.jobid, job.status, job.queue, job.job_name, job.model_version, job.run_folder)
+
+#----------------------------------------------------------------------
+# Helper function
+def progress_text(progress):
+    """Draws a progress bar out of text for the progress column"""
+    filled = int(progress*PROGRESS_CELLS/100)
+    return u"█"*filled + u"░"*(PROGRESS_CELLS-filled) + u" {:3d}%".format(int(progress))
+
+#----------------------------------------------------------------------
+# Helper function
+def trim_lines(text_ctrl, max_lines):
+    """
+    Drops the oldest lines of a text control down to max_lines.
+    Waits until it is a tenth over the limit so the text is not moved on every append
+    """
+    excess = text_ctrl.GetNumberOfLines() - max_lines
+    if excess > max_lines/10:
+        text_ctrl.Remove(0, text_ctrl.XYToPosition(0, excess))
+
 
 if __name__ == "__main__":
     #Run the program